@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Benchmark for host selection on a simulated cluster.  `ssh` is replaced by a
+# local stand-in that answers `prt get_load` and `prt progress` for made-up
+# hosts and "runs" transcodes by sleeping, so everything happens on this box
+# without any network.  Bursts of concurrent `prt_remote` starts are driven
+# through the real `transcode_remote`, and the selection latency percentiles,
+# the placements per host and the balance error are reported.
+#
+# The simulated load of a host is its base load plus `--job-load` (divided by
+# its capacity) for every transcode started more than `--load-lag` seconds
+# ago, as load averages lag behind.  Transcodes run at
+# `capacity * 3 / (1 + load/100)` times realtime.
+#
+# Usage: python benchmarks/bench_cluster.py [options]  (see --help)
+#
+
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+
+import prt
+
+FAKE_SSH = r'''#!%(python)s
+import json, os, random, re, sys, time
+
+SIM = %(sim)r
+hosts = json.load(open(os.path.join(SIM, "hosts.json")))
+opts  = json.load(open(os.path.join(SIM, "options.json")))
+
+# Skip the ssh options and find "user@host" and the remote command
+args, dest = sys.argv[1:], None
+while args:
+    arg = args.pop(0)
+    if arg in ("-p", "-o", "-R", "-S", "-O"):
+        args.pop(0)
+    elif arg.startswith("-"):
+        continue
+    elif dest is None:
+        dest = arg
+    else:
+        args.insert(0, arg)
+        break
+host = hosts[dest.split("@")[-1]]
+name = dest.split("@")[-1]
+command = " ".join(args)
+
+jobs_dir = os.path.join(SIM, "jobs", name)
+
+def get_load():
+    now, load = time.time(), host["base_load"]
+    for job in os.listdir(jobs_dir):
+        try:
+            if now - os.path.getmtime(os.path.join(jobs_dir, job)) >= opts["load_lag"]:
+                load += opts["job_load"] / host["capacity"]
+        except OSError:
+            pass
+    return load
+
+if "prt_local" in command:
+    prt_id = re.search(r"PRT_ID=([0-9a-f]{32})", command).group(1)
+    path = os.path.join(jobs_dir, prt_id)
+    open(path, "w").close()
+    speed = host["capacity"] * 3.0 / (1 + get_load() / 100.0)
+    json.dump({"speed": speed, "out_time": opts["duration"] * speed},
+              open(os.path.join(SIM, "progress", prt_id), "w"))
+    time.sleep(opts["duration"])
+    os.unlink(path)
+
+elif command.startswith("prt get_load"):
+    time.sleep(max(0, random.gauss(opts["latency"], opts["latency"] / 4)))
+    if random.random() < opts["failure_rate"]:
+        sys.exit(255)
+    load = get_load()
+    print "%%0.2f %%0.2f %%0.2f" %% (load, load, load)
+
+elif command.startswith("prt progress"):
+    parts = command.split()
+    prt_ids = parts[2:] or os.listdir(os.path.join(SIM, "progress"))
+    records = {}
+    for prt_id in prt_ids:
+        try:
+            records[prt_id] = json.load(open(os.path.join(SIM, "progress", prt_id)))
+        except IOError:
+            pass
+    print json.dumps(records)
+'''
+
+DRIVER = "import prt; prt.transcode_remote()"
+
+
+def setup(options):
+    root = tempfile.mkdtemp(prefix="prt-bench-")
+    sim = os.path.join(root, "sim")
+    os.makedirs(os.path.join(sim, "progress"))
+
+    capacities = [float(c) for c in options.capacities.split(",")] if options.capacities else []
+    hosts = {}
+    for i in range(options.hosts):
+        name = "host-%d" % i
+        hosts[name] = {
+            "capacity":  capacities[i % len(capacities)] if capacities else 1.0,
+            "base_load": random.uniform(0, options.base_load)
+        }
+        os.makedirs(os.path.join(sim, "jobs", name))
+
+    json.dump(hosts, open(os.path.join(sim, "hosts.json"), "w"))
+    json.dump({
+        "latency":      options.latency / 1000.0,
+        "failure_rate": options.failure_rate,
+        "job_load":     options.job_load,
+        "load_lag":     options.load_lag,
+        "duration":     options.duration
+    }, open(os.path.join(sim, "options.json"), "w"))
+
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir)
+    ssh = os.path.join(bin_dir, "ssh")
+    with open(ssh, "w") as fh:
+        fh.write(FAKE_SSH % {"python": sys.executable, "sim": sim})
+    os.chmod(ssh, 0755)
+
+    config = prt.DEFAULT_CONFIG.copy()
+    config.update({
+        "servers":        dict((h, {"port": "22", "user": "plex", "capacity": c["capacity"]})
+                               for h, c in hosts.items()),
+        "state_dir":      os.path.join(root, "state"),
+        "scheduler":      options.scheduler,
+        "load_cache_ttl": options.cache_ttl,
+        "ssh_multiplex":  False,
+        "logging":        json.loads(json.dumps(config["logging"]))
+    })
+    config["logging"]["handlers"]["file_handler"]["filename"] = os.path.join(root, "prt.log")
+    json.dump(config, open(os.path.join(root, ".prt.conf"), "w"))
+
+    return root, hosts, config
+
+
+def run_bursts(root, options):
+    env = dict(os.environ,
+               HOME=root,
+               PATH=os.path.join(root, "bin") + os.pathsep + os.environ["PATH"],
+               PYTHONPATH=REPO)
+
+    # The throughput scheduler learns from the refresher sampling running transcodes
+    refresher = None
+    if options.scheduler == "throughput":
+        refresher = subprocess.Popen([sys.executable, "-c", "import prt; prt.main()",
+                                      "refresh_load", "1"], env=env, cwd=root)
+
+    procs = []
+    for burst in range(options.bursts):
+        for i in range(options.concurrency):
+            # A video encode, so that the default job classes don't keep it local
+            args = ["-i", "/media/movie-%d-%d.mkv" % (burst, i), "-codec:0", "libx264",
+                    "/transcode/session/bench-%d-%d/base/index.m3u8" % (burst, i)]
+            procs.append(subprocess.Popen([sys.executable, "-c", DRIVER] + args, env=env, cwd=root))
+        time.sleep(options.interval)
+
+    for proc in procs:
+        proc.wait()
+
+    if refresher is not None:
+        refresher.kill()
+        refresher.wait()
+
+
+def report(config, hosts):
+    latencies, placements = [], dict((h, 0) for h in hosts)
+    with open(prt.get_state_path(config, "trace.jsonl")) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record["role"] != "remote" or record.get("host") not in hosts:
+                continue
+            select = [s for s in record["spans"] if s["name"] == "select"][0]
+            latencies.append(select["offset"] + select["duration"])
+            placements[record["host"]] += 1
+
+    if not latencies:
+        print "No transcodes were placed on a remote host"
+        return
+
+    print "Selection latency (%d placements)" % len(latencies)
+    for pct in (50, 95, 99):
+        print "  p%d: %8.2f ms" % (pct, prt.percentile(latencies, pct) * 1000)
+    print "  max: %7.2f ms" % (max(latencies) * 1000)
+    print
+
+    total = float(sum(placements.values()))
+    capacity = sum(h["capacity"] for h in hosts.values())
+    print "Placements"
+    print "  %-10s %8s %10s %8s %8s" % ("host", "capacity", "base load", "count", "share")
+    error = 0.0
+    for name in sorted(hosts, key=lambda h: int(h.split("-")[1])):
+        share = placements[name] / total
+        error += abs(share - hosts[name]["capacity"] / capacity)
+        print "  %-10s %8.1f %9.1f%% %8d %7.1f%%" % (
+            name, hosts[name]["capacity"], hosts[name]["base_load"], placements[name], share * 100)
+    print
+    # Half the L1 distance from the capacity-proportional split: the fraction
+    # of transcodes that would have to move elsewhere to be perfectly balanced
+    print "Balance error: %0.3f" % (error / 2)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--hosts", type="int", default=8)
+    parser.add_option("--capacities", help="comma separated capacities, repeated over the hosts")
+    parser.add_option("--base-load", type="float", default=20.0,
+                      help="base loads are uniform between 0 and this")
+    parser.add_option("--latency", type="float", default=20.0, help="mean probe latency in ms")
+    parser.add_option("--failure-rate", type="float", default=0.0, help="probability a probe fails")
+    parser.add_option("--job-load", type="float", default=25.0, help="load added by each transcode")
+    parser.add_option("--load-lag", type="float", default=5.0,
+                      help="seconds before a transcode shows in the load")
+    parser.add_option("--duration", type="float", default=10.0, help="seconds each transcode runs")
+    parser.add_option("--bursts", type="int", default=5)
+    parser.add_option("--concurrency", type="int", default=8, help="transcode starts per burst")
+    parser.add_option("--interval", type="float", default=2.0, help="seconds between bursts")
+    parser.add_option("--scheduler", default=prt.DEFAULT_CONFIG["scheduler"],
+                      choices=sorted(prt.SCHEDULERS))
+    parser.add_option("--cache-ttl", type="float", default=prt.DEFAULT_CONFIG["load_cache_ttl"])
+    parser.add_option("--seed", type="int")
+    parser.add_option("--keep", action="store_true", help="keep the simulation directory")
+    options, args = parser.parse_args()
+
+    random.seed(options.seed)
+    root, hosts, config = setup(options)
+    try:
+        run_bursts(root, options)
+        report(config, hosts)
+    finally:
+        if options.keep:
+            print "Simulation kept in %s" % root
+        else:
+            shutil.rmtree(root)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Benchmark for the two halves of `prt sessions`: the process scan and the
+# parsing of Plex's /status/sessions response.  Each is compared against the
+# implementation it replaced, at increasing sizes.
+#
+# Usage: python benchmarks/bench_sessions.py [max_procs] [max_sessions]
+#
+
+import os
+import subprocess
+import sys
+import time
+
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import psutil
+import prt
+
+SESSION_XML = (
+    '<Video key="/library/metadata/%(i)d" title="Movie %(i)d">'
+    '<Media><Part file="/media/movies/movie-%(i)d.mkv"/></Media>'
+    '<User id="1" title="user"/>'
+    '<Player address="10.0.0.%(i)d" state="playing"/>'
+    '<TranscodeSession key="session-%(i)d" progress="12.5" speed="1.5"/>'
+    '</Video>'
+)
+
+
+def old_process_scan():
+    found = 0
+    for proc in psutil.process_iter():
+        try:
+            parent_name = proc.parent().name()
+        except:
+            continue
+
+        if not parent_name:
+            continue
+
+        pinfo = proc.as_dict(['name', 'cmdline'])
+        if pinfo['name'] == 'ssh' and 'plex' in parent_name.lower():
+            if prt.PRT_ID_RE.search(' '.join(pinfo['cmdline'])):
+                found += 1
+    return found
+
+
+def new_process_scan():
+    return len(list(prt.iter_prt_processes()))
+
+
+def old_parse(fh):
+    dom = prt.ET.parse(fh)
+    sessions = {}
+    for node in dom.findall('.//Video'):
+        session_id = prt.et_get(node.find('.//TranscodeSession'), 'key')
+        if session_id:
+            sessions[session_id] = {
+                'file':     prt.et_get(node.find('.//Media/Part'), 'file'),
+                'progress': prt.et_get(node.find('.//TranscodeSession'), 'progress')
+            }
+    return sessions
+
+
+def new_parse(fh):
+    return prt.parse_plex_sessions(fh)
+
+
+def timeit(func, make_arg=None, repeat=5):
+    best = None
+    for i in range(repeat):
+        arg = make_arg() if make_arg else None
+        start = time.time()
+        func(arg) if make_arg else func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_process_scan(max_procs):
+    print "Process scan (best of 5)"
+    print "  %10s %12s %12s" % ("processes", "old (ms)", "new (ms)")
+
+    children = []
+    try:
+        count = 0
+        while count <= max_procs:
+            total = len(psutil.pids())
+            old = timeit(old_process_scan)
+            new = timeit(new_process_scan)
+            print "  %10d %12.2f %12.2f" % (total, old*1000, new*1000)
+
+            step = max(100, count)
+            for i in range(step):
+                children.append(subprocess.Popen(["sleep", "600"]))
+            count += step
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+def bench_xml_parse(max_sessions):
+    print "Sessions XML parse (best of 5)"
+    print "  %10s %12s %12s" % ("sessions", "old (ms)", "new (ms)")
+
+    count = 10
+    while count <= max_sessions:
+        xml = '<MediaContainer size="%d">%s</MediaContainer>' % (
+            count, ''.join(SESSION_XML % {'i': i} for i in range(count)))
+        assert old_parse(StringIO(xml)) == new_parse(StringIO(xml))
+
+        old = timeit(old_parse, lambda: StringIO(xml))
+        new = timeit(new_parse, lambda: StringIO(xml))
+        print "  %10d %12.2f %12.2f" % (count, old*1000, new*1000)
+        count *= 10
+
+
+if __name__ == "__main__":
+    max_procs    = int(sys.argv[1]) if len(sys.argv) > 1 else 1600
+    max_sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    bench_process_scan(max_procs)
+    print
+    bench_xml_parse(max_sessions)
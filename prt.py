@@ -2,19 +2,32 @@
 # Weston Nielson <wnielson@github>
 #
 
+import BaseHTTPServer
+import contextlib
+import fcntl
 import filecmp
+import fnmatch
 import getpass
+import hashlib
 import json
 import logging
 import logging.config
+import math
 import multiprocessing
 import os
 import pipes
+import pwd
+import random
 import re
+import select
 import shlex
 import shutil
+import socket
+import stat
+import SocketServer
 import subprocess
 import sys
+import threading
 import time
 import urllib
 import urllib2
@@ -52,8 +65,55 @@ DEFAULT_CONFIG = {
     "ipaddress": "",
     "path_script":    None,
     "servers_script": None,
+    "servers_script_ttl":     60.0,
+    "servers_script_timeout": 10.0,
     "servers":   {},
     "auth_token": None,
+    "state_dir": "~/.prt",
+    "probe_timeout":  5.0,
+    "probe_deadline": 3.0,
+    "load_cache_ttl": 10.0,
+    "ssh_multiplex":  True,
+    "ssh_control_persist": 600,
+    "agent_address": "0.0.0.0",
+    "agent_port":    32442,
+    "scheduler":     "min_load",
+    "throughput_samples": 20,
+    "load_weights":  [0.6, 0.3, 0.1],
+    "job_classes": [
+        {"name": "light", "video_encode": False, "placement": "local"},
+        {"name": "heavy", "source_codecs": ["hevc", "vp9", "av1"], "placement": "strongest"},
+        {"name": "heavy", "min_height": 2160, "placement": "strongest"},
+        {"name": "heavy", "source_patterns": ["*2160p*", "*[._ -]4k[._ -]*", "*uhd*"],
+         "placement": "strongest"},
+        {"name": "video", "placement": "schedule"}
+    ],
+    "max_transcodes":          None,
+    "max_transcodes_per_host": None,
+    "queue_timeout":   10.0,
+    "queue_max_depth": 10,
+    "master_candidate": False,
+    "master_capacity":  1.0,
+    "master_headroom":  25.0,
+    "reservation_load": 25.0,
+    "reservation_ttl":  60.0,
+    "breaker_threshold":   3,
+    "breaker_backoff":     30.0,
+    "breaker_max_backoff": 600.0,
+    "failover_window": 10.0,
+    "failover_budget": 20.0,
+    "session_affinity_ttl":      300.0,
+    "session_affinity_max_load": 80.0,
+    "metrics_address": "0.0.0.0",
+    "metrics_port":    32443,
+    "watchdog_interval": 1.0,
+    "progress_interval": 2.0,
+    "progress_ttl":      3600.0,
+    "env_allow": ["*"],
+    "env_deny":  ["SSH_*", "DISPLAY", "MAIL", "OLDPWD", "PWD", "SHLVL", "TERM", "XDG_*", "_"],
+    "path_mappings": [],
+    "path_script_timeout":    5.0,
+    "path_script_persistent": False,
     "logging":   {
         "version": 1,
         "disable_existing_loggers": False,
@@ -83,6 +143,21 @@ DEFAULT_CONFIG = {
     }
 }
 
+# Output codecs that don't mean a video encode
+AUDIO_CODECS    = set(["aac", "ac3", "eac3", "mp3", "libmp3lame", "opus", "libopus", "vorbis",
+                       "libvorbis", "flac", "alac", "truehd", "dca"])
+SUBTITLE_CODECS = set(["ass", "ssa", "srt", "subrip", "mov_text", "webvtt", "dvd_subtitle",
+                       "dvb_subtitle", "hdmv_pgs_subtitle"])
+# Codec options that only ever select an audio or subtitle codec
+NON_VIDEO_CODEC_ARGS = set(["-acodec", "-scodec"])
+
+CODEC_ARGS  = set(["-codec", "-c", "-vcodec", "-acodec", "-scodec"])
+SCALE_RE    = re.compile(r'scale=(?:w=)?(-?\d+):(?:h=)?(-?\d+)')
+BITRATE_RE  = re.compile(r'^(\d+(?:\.\d+)?)([kKmM]?)$')
+
+# The name the master goes by when it is a scheduling candidate
+MASTER_HOST = "local"
+
 # This is the name we give to the original transcoder, which must be renamed
 NEW_TRANSCODER_NAME      = "plex_transcoder"
 ORIGINAL_TRANSCODER_NAME = "Plex Transcoder"
@@ -91,12 +166,27 @@ REMOTE_ARGS = ("%(env)s;"
                "cd %(working_dir)s;"
                "%(command)s %(args)s")
 
+# Returned by ``prt_local`` if the transcoder couldn't be started, like a shell
+# does for a command it can't execute
+SPAWN_FAILED = 126
+
+# Exit codes of the ``ssh`` running ``prt_local`` that mean the transcode never
+# started on the host: ``ssh`` couldn't connect (255), the remote shell
+# couldn't find or run ``prt_local`` (127, 126) or ``prt_local`` couldn't
+# start the transcoder (``SPAWN_FAILED``).  Any other code is the
+# transcoder's own.
+LAUNCH_FAILURES = set([255, 127, 126, SPAWN_FAILED])
+
 LOAD_AVG_RE = re.compile(r"load averages: ([\d\.]+) ([\d\.]+) ([\d\.]+)")
 
 PRT_ID_RE   = re.compile(r'PRT_ID=([0-9a-f]{32})', re.I)
 SESSION_RE  = re.compile(r'/session/([^/]*)/')
 SSH_HOST_RE = re.compile(r'ssh +([^@]+)@([^ ]+)')
 
+# Matches the fields of ffmpeg's "frame= ... speed=1.5x" status lines as well
+# as the "key=value" lines written with "-progress"
+PROGRESS_RE = re.compile(r'(?<![\w])(frame|fps|bitrate|out_time|time|speed)=\s*(\S+)')
+
 __author__  = "Weston Nielson <wnielson@github>"
 __version__ = "0.4.4"
 
@@ -118,6 +208,201 @@ def save_config(d):
     return False
 
 
+def get_state_path(config, name):
+    """
+    Returns the path to the state file ``name`` inside of the PRT state
+    directory, creating the directory if needed.
+    """
+    state_dir = os.path.expanduser(config.get("state_dir", DEFAULT_CONFIG["state_dir"]))
+    if not os.path.isdir(state_dir):
+        try:
+            os.makedirs(state_dir)
+        except OSError:
+            if not os.path.isdir(state_dir):
+                raise
+    return os.path.join(state_dir, name)
+
+
+def read_state(path):
+    """
+    Returns the contents of the JSON state file at ``path``, or an empty dict
+    if it doesn't exist (yet).  State files are replaced atomically, so they
+    can be read without holding the lock.
+    """
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_state(path, data):
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, "w") as fh:
+        json.dump(data, fh)
+    os.rename(tmp_path, path)
+
+
+@contextlib.contextmanager
+def locked_state(path):
+    """
+    Context manager for a read-modify-write of the JSON state file at
+    ``path``.  An exclusive lock is held for the duration, so that many
+    ``prt`` processes can safely share the same file.
+    """
+    with open(path + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+        try:
+            data = read_state(path)
+            yield data
+            write_state(path, data)
+        finally:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+
+# Bucket upper bounds (in seconds) for each histogram metric
+METRIC_BUCKETS = {
+    "prt_probe_latency_seconds":      [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    "prt_host_selection_seconds":     [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+    "prt_transcode_duration_seconds": [10, 30, 60, 300, 900, 1800, 3600, 7200, 14400],
+    "prt_queue_wait_seconds":         [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+    "prt_queue_depth":                [0, 1, 2, 5, 10, 20, 50],
+}
+
+METRIC_HELP = {
+    "prt_probe_latency_seconds":      "Time taken to probe the load of a host",
+    "prt_probe_failures_total":       "Load probes that failed or timed out",
+    "prt_host_selection_seconds":     "Time from transcode start until a host was selected",
+    "prt_placements_total":           "Transcodes placed on each host",
+    "prt_local_fallbacks_total":      "Transcodes run on the master instead of a remote host",
+    "prt_transcode_duration_seconds": "Duration of finished transcodes",
+    "prt_transcode_exits_total":      "Finished transcodes by exit code",
+    "prt_failovers_total":            "Transcodes retried elsewhere after failing early on a host",
+    "prt_breaker_opens_total":        "Times the circuit breaker of a host was opened",
+    "prt_queue_wait_seconds":         "Time transcode starts waited in the queue for a free slot",
+    "prt_queue_depth":                "Number of waiting transcode starts, including itself, when one joined the queue",
+    "prt_reaped_orphans_total":       "Orphaned ssh processes killed by the reaper",
+    "prt_reaped_transcodes_total":    "Transcoders killed because their session had gone away",
+}
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted((labels or {}).items()))
+
+
+def record_metrics(config, counters=(), histograms=()):
+    """
+    Updates the shared metrics store.  ``counters`` and ``histograms`` are
+    lists of ``(name, labels, value)`` tuples; counters are incremented by
+    ``value`` while histograms observe it.  All updates are applied under a
+    single lock, so callers should batch them.
+    """
+    try:
+        with locked_state(get_state_path(config, "metrics.json")) as metrics:
+            for name, labels, value in counters:
+                series = metrics.setdefault("counters", {}).setdefault(name, {})
+                key = format_labels(labels)
+                series[key] = series.get(key, 0) + value
+
+            for name, labels, value in histograms:
+                series = metrics.setdefault("histograms", {}).setdefault(name, {})
+                data = series.setdefault(format_labels(labels), {
+                    "buckets": [0] * len(METRIC_BUCKETS[name]),
+                    "sum":     0.0,
+                    "count":   0
+                })
+                for i, bound in enumerate(METRIC_BUCKETS[name]):
+                    if value <= bound:
+                        data["buckets"][i] += 1
+                data["sum"] += value
+                data["count"] += 1
+    except (IOError, OSError), e:
+        log.error("Error recording metrics: %s" % str(e))
+
+
+class Trace(object):
+    """
+    Collects per-phase timings of a single ``prt_remote`` or ``prt_local``
+    invocation, keyed by its ``PRT_ID``, and appends them as one JSON line to
+    the trace log in the state directory.
+    """
+
+    # The trace log is rotated once it grows beyond this many bytes
+    MAX_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, config, role, prt_id, start=None):
+        self.config = config
+        self.record = {
+            "id":    prt_id,
+            "role":  role,
+            "start": start or time.time(),
+            "spans": []
+        }
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record["spans"].append({
+                "name":     name,
+                "offset":   start - self.record["start"],
+                "duration": time.time() - start
+            })
+
+    def write(self, **extra):
+        self.record.update(extra)
+        self.record["total"] = time.time() - self.record["start"]
+        try:
+            path = get_state_path(self.config, "trace.jsonl")
+            if os.path.exists(path) and os.path.getsize(path) > self.MAX_SIZE:
+                os.rename(path, path + ".1")
+            # A single append of one line doesn't interleave with other writers
+            with open(path, "a") as fh:
+                fh.write(json.dumps(self.record) + "\n")
+        except (IOError, OSError), e:
+            log.error("Error writing trace: %s" % str(e))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def summarize_traces(config, count=1000):
+    """
+    Prints the p50/p95 duration of each phase over the last ``count``
+    invocations in the trace log.
+    """
+    path = get_state_path(config, "trace.jsonl")
+    records = []
+    for name in (path + ".1", path):
+        try:
+            with open(name) as fh:
+                for line in fh:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except IOError:
+            pass
+    records = records[-count:]
+
+    phases = {}
+    for record in records:
+        for span in record["spans"]:
+            phases.setdefault((record["role"], span["name"]), []).append(span["duration"])
+        phases.setdefault((record["role"], "total"), []).append(record["total"])
+
+    print "Startup phases over the last %d invocations\n" % len(records)
+    print "  %-8s %-16s %7s %10s %10s" % ("Role", "Phase", "Count", "p50 (ms)", "p95 (ms)")
+    for (role, phase), durations in sorted(phases.items()):
+        print "  %-8s %-16s %7d %10.1f %10.1f" % (role, phase, len(durations),
+            percentile(durations, 50) * 1000, percentile(durations, 95) * 1000)
+
+
 def printf(message, *args, **kwargs):
     color = kwargs.get('color')
     attrs = kwargs.get('attrs')
@@ -158,112 +443,1987 @@ def get_system_load_local():
     return [l/nproc * 100 for l in load]
 
 
-def get_system_load_remote(host, port, user):
+def get_system_status_local():
+    """
+    Returns a dict describing the load, cores, memory and running transcodes of
+    this machine.
+    """
+    memory = psutil.virtual_memory()
+
+    transcodes = 0
+    for proc in psutil.process_iter():
+        try:
+            if proc.name() == NEW_TRANSCODER_NAME:
+                transcodes += 1
+        except psutil.Error:
+            pass
+
+    return {
+        "load":   get_system_load_local(),
+        "cores":  multiprocessing.cpu_count(),
+        "memory": {
+            "total":     memory.total,
+            "available": memory.available,
+            "percent":   memory.percent
+        },
+        "transcodes": transcodes
+    }
+
+
+def communicate_with_timeout(proc, timeout=None):
+    """
+    Like ``proc.communicate()`` but kills ``proc`` if it hasn't exited after
+    ``timeout`` seconds.  Returns ``None`` if the process was killed.
+    """
+    if timeout is None:
+        return proc.communicate()
+
+    killed = []
+    def kill():
+        try:
+            proc.kill()
+            killed.append(True)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = proc.communicate()
+    finally:
+        timer.cancel()
+
+    if killed:
+        return None
+    return output
+
+
+def get_ssh_control_path(config, host, port, user):
+    """
+    Returns the path of the control socket used to multiplex SSH connections
+    to ``user@host:port``.  The name is hashed to stay clear of the socket
+    path length limit.
+    """
+    digest = hashlib.md5("%s@%s:%s" % (user, host, port)).hexdigest()[:16]
+    return get_state_path(config, "ssh-%s" % digest)
+
+
+def ensure_ssh_master(config, host, port, user, timeout=None):
+    """
+    Makes sure a healthy multiplexed master connection to ``host`` exists,
+    (re-)establishing it if needed.  Returns the control socket path, or
+    ``None`` if no master could be established.
+    """
+    path = get_ssh_control_path(config, host, port, user)
+    dest = ["%s@%s" % (user, host), "-p", str(port)]
+
+    devnull = open(os.devnull, "w")
+    try:
+        # Only one process may (re-)establish the master for a given host
+        with open(path + ".lock", "a") as lock_fh:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+
+            if os.path.exists(path):
+                if subprocess.call(["ssh", "-S", path, "-O", "check"] + dest,
+                                   stdout=devnull, stderr=devnull) == 0:
+                    return path
+
+                log.info("SSH master for host '%s' is dead...re-establishing" % host)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+            # The master also carries the tunnel back to PMS, so that it stays
+            # up for as long as the master does.
+            args = ["ssh", "-M", "-N", "-f", "-S", path,
+                    "-o", "ControlPersist=%s" % config.get("ssh_control_persist", DEFAULT_CONFIG["ssh_control_persist"]),
+                    "-R", "32400:127.0.0.1:32400"] + dest
+            if timeout:
+                args += ["-o", "ConnectTimeout=%d" % max(1, int(math.ceil(timeout)))]
+
+            log.debug("Establishing SSH master for host '%s'" % host)
+            proc = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+            if communicate_with_timeout(proc, timeout) is None or proc.returncode != 0:
+                log.error("Couldn't establish SSH master for host '%s'" % host)
+                return None
+            return path
+    except (IOError, OSError), e:
+        log.error("Error establishing SSH master for host '%s': %s" % (host, str(e)))
+        return None
+    finally:
+        devnull.close()
+
+
+def ssh_command(host, port, user, config=None, timeout=None):
+    """
+    Returns the ``ssh`` arguments (up to, but not including, the remote
+    command) for connecting to ``user@host:port``.  When ``ssh_multiplex`` is
+    enabled the connection reuses a master managed by ``ensure_ssh_master``.
+    """
+    if config is None:
+        config = get_config()
+
+    args = ["ssh", "%s@%s" % (user, host), "-p", str(port)]
+    if timeout:
+        args += ["-o", "ConnectTimeout=%d" % max(1, int(math.ceil(timeout)))]
+
+    if config.get("ssh_multiplex", DEFAULT_CONFIG["ssh_multiplex"]):
+        path = ensure_ssh_master(config, host, port, user, timeout=timeout)
+        if path:
+            args += ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % path]
+
+    return args
+
+
+def stop_ssh_master(config, host, port, user):
+    """
+    Asks the multiplexed master connection to ``host`` to exit.
+    """
+    path = get_ssh_control_path(config, host, port, user)
+    if not os.path.exists(path):
+        return False
+    return subprocess.call(["ssh", "-S", path, "-O", "exit", "%s@%s" % (user, host),
+                            "-p", str(port)]) == 0
+
+
+def get_system_load_remote(host, port, user, timeout=None, agent_port=None, config=None):
+    """
+    Gets the result from ``get_system_load_local`` of a remote machine.  If
+    ``timeout`` is given the probe is abandoned after that many seconds.  If
+    the host runs a ``prt agent`` on ``agent_port`` it is asked directly,
+    falling back to SSH if that fails.
+    """
+    if agent_port:
+        try:
+            return query_agent(host, agent_port, "load", timeout=timeout)["load"]
+        except (socket.error, ValueError, KeyError), e:
+            log.debug("Couldn't query agent on host '%s': %s" % (host, str(e)))
+
+    start = time.time()
+    args = ssh_command(host, port, user, config=config, timeout=timeout) + ["prt", "get_load"]
+    if timeout:
+        # Establishing the SSH master counts towards the timeout too
+        timeout = max(0.01, timeout - (time.time() - start))
+
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        log.error("Error probing load for host '%s': %s" % (host, str(e)))
+        return []
+
+    output = communicate_with_timeout(proc, timeout)
+    if output is None:
+        log.debug("Load probe for host '%s' timed out after %ss" % (host, timeout))
+        return []
+
+    try:
+        return [float(i) for i in output[0].strip().split()]
+    except ValueError:
+        return []
+
+
+def get_cluster_loads(servers, timeout=None, deadline=None, on_late_result=None, latencies=None,
+                      config=None):
+    """
+    Probes the load of every host in ``servers`` at the same time.  Returns a
+    tuple ``(loads, missed)`` where ``loads`` maps each hostname that answered
+    within ``deadline`` seconds to the result of ``get_system_load_remote`` and
+    ``missed`` is a list of the hostnames that didn't.  Probes that finish
+    after the deadline are passed to ``on_late_result(hostname, load)``.  If
+    ``latencies`` is given, the duration of each finished probe is stored in it.
+    """
+    results = {}
+    finished = []
+
+    def probe(hostname, host):
+        start = time.time()
+        load = get_system_load_remote(hostname, host["port"], host["user"], timeout=timeout,
+                                      agent_port=host.get("agent_port"), config=config)
+        if latencies is not None:
+            latencies[hostname] = time.time() - start
+        results[hostname] = load
+        if finished and on_late_result is not None:
+            on_late_result(hostname, load)
+
+    threads = []
+    for hostname, host in servers.items():
+        thread = threading.Thread(target=probe, args=(hostname, host))
+        thread.daemon = True
+        thread.start()
+        threads.append((hostname, thread))
+
+    end = None
+    if deadline is not None:
+        end = time.time() + deadline
+
+    for hostname, thread in threads:
+        if end is None:
+            thread.join()
+        else:
+            thread.join(max(0, end - time.time()))
+
+    # Take a snapshot so that stragglers finishing now don't change the result
+    finished.append(True)
+    loads = dict(results)
+    missed = [hostname for hostname, thread in threads if hostname not in loads]
+    return loads, missed
+
+
+def record_probe_metrics(config, loads, latencies):
+    record_metrics(config,
+        counters=[("prt_probe_failures_total", {"host": h}, 1) for h, l in loads.items() if not l],
+        histograms=[("prt_probe_latency_seconds", {"host": h}, t) for h, t in latencies.items()])
+
+
+def get_probe_settings(config):
+    """
+    Returns the ``(timeout, deadline)`` to use for load probes.
+    """
+    return (config.get("probe_timeout", DEFAULT_CONFIG["probe_timeout"]),
+            config.get("probe_deadline", DEFAULT_CONFIG["probe_deadline"]))
+
+
+def update_load_cache(config, loads):
+    """
+    Stores the probe results in ``loads`` (hostname to load list) in the shared
+    load cache.  Failed probes are cached too, so that an unreachable host
+    isn't re-probed until its entry expires.
+    """
+    ttl = config.get("load_cache_ttl", DEFAULT_CONFIG["load_cache_ttl"])
+    now = time.time()
+    with locked_state(get_state_path(config, "load_cache.json")) as cache:
+        for hostname, load in loads.items():
+            cache[hostname] = {
+                "load":    load,
+                "updated": now,
+                "expires": now + ttl
+            }
+
+
+def get_cached_loads(config, servers, probe=True):
+    """
+    Returns ``(loads, missed)`` like ``get_cluster_loads``, but answers from
+    the shared load cache where possible.  Only hosts whose entries are
+    missing or expired are probed, unless ``probe`` is ``False`` in which
+    case they are reported as missed.
+    """
+    cache = read_state(get_state_path(config, "load_cache.json"))
+    now = time.time()
+
+    loads, expired = {}, {}
+    for hostname, host in servers.items():
+        entry = cache.get(hostname)
+        if entry and entry.get("expires", 0) > now:
+            loads[hostname] = entry["load"]
+        else:
+            expired[hostname] = host
+
+    if not expired:
+        return loads, []
+
+    if not probe:
+        return loads, sorted(expired)
+
+    log.debug("Probing hosts with missing or expired load: %s" % ", ".join(sorted(expired)))
+    timeout, deadline = get_probe_settings(config)
+    latencies = {}
+
+    def on_late_result(hostname, load):
+        update_load_cache(config, {hostname: load})
+        # Missing the deadline already counted as a failure, only an answer
+        # can still close the breaker
+        if load:
+            record_host_results(config, {hostname: True}, probe=True)
+
+    probed, missed = get_cluster_loads(expired, timeout=timeout, deadline=deadline,
+                                       on_late_result=on_late_result,
+                                       latencies=latencies, config=config)
+    if probed:
+        update_load_cache(config, probed)
+        record_probe_metrics(config, probed, dict((h, latencies[h]) for h in probed))
+    if probed or missed:
+        # A host that hangs never fails its probe in time, so missing the
+        # deadline counts as a failed probe
+        results = dict((h, bool(l)) for h, l in probed.items())
+        results.update((h, False) for h in missed)
+        record_host_results(config, results, probe=True)
+    loads.update(probed)
+    return loads, missed
+
+
+def refresh_load_cache(config, servers):
+    """
+    Probes every host in ``servers`` and stores the results in the load cache.
+    """
+    timeout = get_probe_settings(config)[0]
+    latencies = {}
+    loads, missed = get_cluster_loads(servers, timeout=timeout, latencies=latencies, config=config)
+    update_load_cache(config, loads)
+    record_probe_metrics(config, loads, latencies)
+    record_host_results(config, dict((h, bool(l)) for h, l in loads.items()), probe=True)
+    return loads
+
+
+def run_servers_script(config):
+    """
+    Runs ``servers_script`` and returns the hosts it lists, or ``None`` if it
+    failed, timed out or printed something that isn't a host list.
+    """
+    try:
+        proc = subprocess.Popen([config["servers_script"]], stdout=subprocess.PIPE)
+        output = communicate_with_timeout(proc, config.get("servers_script_timeout",
+                                                           DEFAULT_CONFIG["servers_script_timeout"]))
+    except OSError, e:
+        log.error("Error retreiving host list via '%s': %s" % (config["servers_script"], str(e)))
+        return None
+
+    if output is None:
+        log.error("Timed out retreiving host list via '%s'" % config["servers_script"])
+        return None
+    if proc.returncode != 0:
+        log.error("'%s' exited with code %d" % (config["servers_script"], proc.returncode))
+        return None
+
+    servers = {}
+    for line in output[0].splitlines():
+        if not line.strip():
+            continue
+        try:
+            hostname, port, user = line.strip().split()
+        except ValueError:
+            log.error("Invalid line from '%s': %s" % (config["servers_script"], line.strip()))
+            return None
+        servers[hostname] = {
+            "port": port,
+            "user": user
+        }
+    return servers
+
+
+def refresh_servers_cache(config, block=True):
+    """
+    Runs ``servers_script`` and stores its hosts in the servers cache.  Only
+    one process refreshes at a time; unless ``block`` is set, others return
+    straight away instead of waiting for it.  Returns ``True`` if the cache
+    was updated.
+    """
+    path = get_state_path(config, "servers.json")
+    with open(path + ".refresh", "a") as lock_fh:
+        try:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+        except IOError:
+            return False
+        try:
+            servers = run_servers_script(config)
+            if servers is None:
+                return False
+
+            ttl = config.get("servers_script_ttl", DEFAULT_CONFIG["servers_script_ttl"])
+            with locked_state(path) as cache:
+                cache["servers"] = servers
+                cache["expires"] = time.time() + ttl
+            return True
+        finally:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+
+def get_servers(config):
+    """
+    Returns the transcode hosts.  When ``servers_script`` is set its output is
+    cached for ``servers_script_ttl`` seconds; an expired list is still used
+    while a background thread refreshes it, and if the script fails the last
+    list it returned is kept.
+    """
+    if not config.get("servers_script", None):
+        return config["servers"]
+
+    path = get_state_path(config, "servers.json")
+    cache = read_state(path)
+    if "servers" not in cache:
+        # Nothing to serve while we wait, so this first run has to block
+        refresh_servers_cache(config)
+        cache = read_state(path)
+        if "servers" not in cache:
+            log.error("No host list available from '%s'" % config["servers_script"])
+            return {}
+    elif cache.get("expires", 0) <= time.time():
+        log.debug("Host list has expired...refreshing in the background")
+        thread = threading.Thread(target=refresh_servers_cache, args=(config, False))
+        thread.daemon = True
+        thread.start()
+
+    return cache["servers"]
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers line-based queries from the master.  Each reply is a single line
+    of JSON.  The supported commands are:
+
+      load            The result of ``get_system_load_local``
+      status          The result of ``get_system_status_local``
+      progress [id]   The result of ``get_progress_local``
+      watch [secs]    Stream ``status`` every [secs] (default 1, at least 0.1) seconds
+    """
+
+    # Shortest ``watch`` interval a client may ask for
+    MIN_INTERVAL = 0.1
+
+    def send(self, data):
+        self.wfile.write(json.dumps(data) + "\n")
+        self.wfile.flush()
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            parts = line.split()
+            if not parts:
+                continue
+
+            if parts[0] == "load":
+                self.send({"load": get_system_load_local()})
+            elif parts[0] == "status":
+                self.send(get_system_status_local())
+            elif parts[0] == "progress":
+                self.send(get_progress_local(get_config(), parts[1] if len(parts) > 1 else None))
+            elif parts[0] == "watch":
+                try:
+                    interval = float(parts[1]) if len(parts) > 1 else 1.0
+                except ValueError:
+                    self.send({"error": "Invalid interval '%s'" % parts[1]})
+                    continue
+                if not interval >= self.MIN_INTERVAL:
+                    interval = self.MIN_INTERVAL
+                try:
+                    while True:
+                        self.send(get_system_status_local())
+                        time.sleep(interval)
+                except socket.error:
+                    return
+            else:
+                self.send({"error": "Unknown command '%s'" % parts[0]})
+
+
+class AgentServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads      = True
+
+
+def run_agent(address, port):
+    """
+    Runs the ``prt agent`` daemon on ``address:port`` until interrupted.
+    """
+    server = AgentServer((address, int(port)), AgentHandler)
+    log.info("Agent listening on %s:%s" % (address, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def query_agent(host, port, command, timeout=None):
+    """
+    Sends ``command`` to the ``prt agent`` on ``host:port`` and returns its
+    decoded reply.
+    """
+    sock = socket.create_connection((host, int(port)), timeout)
+    try:
+        sock.sendall(command + "\n")
+        return json.loads(sock.makefile("r").readline())
+    finally:
+        sock.close()
+
+
+def watch_agent(config, hostname, port, interval):
+    """
+    Subscribes to the status stream of the ``prt agent`` on ``hostname`` and
+    stores every update in the load cache.  Reconnects if the stream breaks.
+    """
+    while True:
+        try:
+            sock = socket.create_connection((hostname, int(port)), get_probe_settings(config)[0])
+            try:
+                # Updates arrive every ``interval`` seconds, so anything much
+                # slower than that means the agent has gone away.
+                sock.settimeout(interval * 3)
+                sock.sendall("watch %s\n" % interval)
+                for line in iter(sock.makefile("r").readline, ""):
+                    update_load_cache(config, {hostname: json.loads(line)["load"]})
+            finally:
+                sock.close()
+        except (socket.error, ValueError, KeyError), e:
+            log.debug("Lost agent stream for host '%s': %s" % (hostname, str(e)))
+
+        time.sleep(interval)
+
+
+def get_system_status_remote(config, hostname, host, timeout=None):
+    """
+    Returns ``get_system_status_local`` of a transcode host, asking its ``prt
+    agent`` if it runs one and falling back to SSH.  Returns ``None`` if the
+    host couldn't be reached in time.
+    """
+    if host.get("agent_port"):
+        try:
+            return query_agent(hostname, host["agent_port"], "status", timeout=timeout)
+        except (socket.error, ValueError), e:
+            log.debug("Couldn't query agent on host '%s': %s" % (hostname, str(e)))
+
+    start = time.time()
+    args = ssh_command(hostname, host["port"], host["user"], config=config,
+                       timeout=timeout) + ["prt", "get_status"]
+    if timeout:
+        timeout = max(0.01, timeout - (time.time() - start))
+
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        log.error("Error getting status of host '%s': %s" % (hostname, str(e)))
+        return None
+
+    output = communicate_with_timeout(proc, timeout)
+    try:
+        return json.loads(output[0]) if output else None
+    except ValueError:
+        return None
+
+
+def get_cluster_status(config, servers):
+    """
+    Queries the status of every host in ``servers`` at the same time and
+    returns a dict mapping each hostname to its status, the time the query
+    took and the number of transcodes placed on it from the placement ledger
+    and the state of its circuit breaker.  Hosts that don't answer within
+    ``probe_timeout`` seconds are reported as unreachable.
+    """
+    timeout = get_probe_settings(config)[0]
+    results, latencies = {}, {}
+
+    def query(hostname, host):
+        start = time.time()
+        try:
+            results[hostname] = get_system_status_remote(config, hostname, host, timeout=timeout)
+        except Exception, e:
+            log.error("Error getting status of host '%s': %s" % (hostname, str(e)))
+        latencies[hostname] = time.time() - start
+
+    threads = []
+    for hostname, host in servers.items():
+        thread = threading.Thread(target=query, args=(hostname, host))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Setting up an SSH master can take a moment on top of the probe itself
+    end = time.time() + timeout + 1
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+
+    placements = read_state(get_state_path(config, "placements.json"))
+    breakers = read_state(get_state_path(config, "breakers.json"))
+
+    cluster = {}
+    for hostname in servers:
+        status = dict(results.get(hostname) or {})
+        status.update({
+            "reachable":  bool(results.get(hostname)),
+            "latency":    latencies.get(hostname),
+            "placements": sum(1 for p in placements.values() if p["host"] == hostname),
+            "breaker":    breakers.get(hostname, {}).get("state", "closed")
+        })
+        cluster[hostname] = status
+    return cluster
+
+
+def show_cluster_status(config, as_json=False):
+    """
+    Prints the status of every transcode host, and of the master if it is a
+    scheduling candidate, as a table or as JSON.
+    """
+    cluster = get_cluster_status(config, get_servers(config))
+    if config.get("master_candidate", DEFAULT_CONFIG["master_candidate"]):
+        placements = read_state(get_state_path(config, "placements.json"))
+        cluster[MASTER_HOST] = dict(get_system_status_local(), reachable=True, latency=0.0,
+            placements=sum(1 for p in placements.values() if p["host"] == MASTER_HOST),
+            breaker="closed")
+
+    if as_json:
+        print json.dumps(cluster, indent=2, sort_keys=True)
+        return
+
+    print "Cluster Status\n"
+    print "  %-20s %8s %-22s %5s %6s %10s %7s" % (
+        "Host", "Latency", "Load (1/5/15 min)", "Cores", "Memory", "Transcodes", "Breaker")
+    for hostname, status in sorted(cluster.items()):
+        if not status["reachable"]:
+            print "  %-20s %8s %-22s %5s %6s %10s %7s" % (
+                hostname, "-", "unreachable", "-", "-", status["placements"], status["breaker"])
+            continue
+        print "  %-20s %6.0fms %-22s %5d %5.0f%% %10s %7s" % (
+            hostname, status["latency"] * 1000,
+            ", ".join("%0.0f%%" % l for l in status["load"]),
+            status["cores"], status["memory"]["percent"],
+            "%d (%d)" % (status["transcodes"], status["placements"]), status["breaker"])
+
+
+def run_load_refresher(config, servers, interval):
+    """
+    Keeps the load cache warm.  Hosts running ``prt agent`` stream their
+    updates, the rest are probed every ``interval`` seconds.  With the
+    ``throughput`` scheduler, running transcodes are sampled as often.
+    """
+    probed = {}
+    for hostname, host in servers.items():
+        if host.get("agent_port"):
+            thread = threading.Thread(target=watch_agent,
+                                      args=(config, hostname, host["agent_port"], interval))
+            thread.daemon = True
+            thread.start()
+        else:
+            probed[hostname] = host
+
+    while True:
+        if probed:
+            refresh_load_cache(config, probed)
+        if config.get("scheduler", DEFAULT_CONFIG["scheduler"]) == "throughput":
+            sample_throughput(config, servers)
+        time.sleep(interval)
+
+
+def render_metrics(config):
+    """
+    Returns all metrics in the Prometheus text exposition format.  Counters and
+    histograms come from the metrics store, host load and active sessions are
+    read from the load cache and the placement ledger.
+    """
+    metrics = read_state(get_state_path(config, "metrics.json"))
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    header("prt_host_load_percent", "gauge", "Load average of each host as a percentage of its cores")
+    for hostname, entry in sorted(read_state(get_state_path(config, "load_cache.json")).items()):
+        for period, load in zip(("1m", "5m", "15m"), entry.get("load", [])):
+            lines.append("prt_host_load_percent{%s} %s" % (
+                format_labels({"host": hostname, "period": period}), load))
+
+    sessions = {}
+    for placement in read_state(get_state_path(config, "placements.json")).values():
+        if psutil.pid_exists(placement["pid"]):
+            sessions[placement["host"]] = sessions.get(placement["host"], 0) + 1
+
+    header("prt_active_sessions", "gauge", "Transcodes currently running on each host")
+    for hostname, count in sorted(sessions.items()):
+        lines.append("prt_active_sessions{%s} %d" % (format_labels({"host": hostname}), count))
+
+    for name, series in sorted(metrics.get("counters", {}).items()):
+        header(name, "counter", METRIC_HELP.get(name, name))
+        for labels, value in sorted(series.items()):
+            lines.append("%s%s %s" % (name, "{%s}" % labels if labels else "", value))
+
+    for name, series in sorted(metrics.get("histograms", {}).items()):
+        header(name, "histogram", METRIC_HELP.get(name, name))
+        for labels, data in sorted(series.items()):
+            prefix = labels + "," if labels else ""
+            for bound, count in zip(METRIC_BUCKETS[name], data["buckets"]):
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, data["count"]))
+            suffix = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %s" % (name, suffix, data["sum"]))
+            lines.append("%s_count%s %d" % (name, suffix, data["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render_metrics(get_config())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request: %s" % (format % args))
+
+
+def run_metrics_server(address, port):
+    """
+    Serves ``render_metrics`` on ``http://address:port/metrics`` until
+    interrupted.
+    """
+    server = BaseHTTPServer.HTTPServer((address, int(port)), MetricsHandler)
+    log.info("Serving metrics on %s:%s" % (address, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def setup_logging():
+    config = get_config()
+    logging.config.dictConfig(config["logging"])
+
+
+def get_transcoder_path(name=NEW_TRANSCODER_NAME):
+    """
+    Returns the full path to ``name`` located in ``TRANSCODER_DIR``.
+    """
+    return os.path.join(TRANSCODER_DIR, name)
+
+
+def rename_transcoder():
+    """
+    Moves the original transcoder "Plex Transcoder" to the new name given
+    by ``TRANSCODER_NAME``.
+    """
+    old_path = get_transcoder_path(ORIGINAL_TRANSCODER_NAME)
+    new_path = get_transcoder_path(NEW_TRANSCODER_NAME)
+
+    if os.path.exists(new_path):
+        print "Transcoder appears to have been renamed previously...not renaming (try overwrite option)"
+        return False
+
+    try:
+        os.rename(old_path, new_path)
+    except Exception, e:
+        print "Error renaming original transcoder: %s" % str(e)
+        return False
+
+    return True
+
+
+def install_transcoder():
+    prt_remote = find_executable("prt_remote")
+    if not prt_remote:
+        print "Couldn't find `prt_remote` executable"
+        return
+
+    print "Renaming original transcoder"
+    if rename_transcoder():
+        try:
+            shutil.copyfile(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME))
+            os.chmod(get_transcoder_path(ORIGINAL_TRANSCODER_NAME), 0755)
+        except Exception, e:
+            print "Error installing new transcoder: %s" % str(e)
+
+
+# Overwrite_transcoder_after_upgrade function
+def overwrite_transcoder_after_upgrade():
+    """
+    Moves the upgraded transcoder "Plex Transcoder" to the new name given
+    by ``TRANSCODER_NAME`` if the plex package has overwritten the old one.
+    """
+    old_path = get_transcoder_path(ORIGINAL_TRANSCODER_NAME)
+    new_path = get_transcoder_path(NEW_TRANSCODER_NAME)
+
+    prt_remote = find_executable("prt_remote")
+    if not prt_remote:
+        print "Couldn't find `prt_remote` executable"
+        sys.exit(2)
+    elif os.path.exists(new_path):
+           print "Transcoder appears to have been renamed previously...checking if it's been overwritten"
+           if not filecmp.cmp(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME), shallow=1):
+               try:
+                   shutil.copyfile(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME))
+                   os.chmod(get_transcoder_path(ORIGINAL_TRANSCODER_NAME), 0755)
+               except Exception, e:
+                   print "Error installing new transcoder: %s" % str(e)
+                   sys.exit(2)
+           else:
+               print "Transcoder hasn't been overwritten by upgrade, nothing to do"
+               sys.exit(1)
+    else:
+         print "Transcoder hasn't been previously installed, please use install option"
+         sys.exit(1)
+
+def get_host_capacity(candidate):
+    """
+    Returns the relative capacity of a candidate host, as given by the optional
+    ``capacity`` entry of its server config (default ``1.0``).
+    """
+    return float(candidate["server"].get("capacity", 1.0))
+
+
+def get_weighted_load(config, candidate):
+    """
+    Returns the 1/5/15-minute loads of ``candidate`` combined using the
+    ``load_weights`` config and divided by the host's capacity.
+    """
+    weights = config.get("load_weights", DEFAULT_CONFIG["load_weights"])
+    load = sum(w*l for w, l in zip(weights, candidate["load"]))
+    return load / get_host_capacity(candidate)
+
+
+def schedule_min_load(config, candidates):
+    hostname = min(candidates, key=lambda h: candidates[h]["load"][0])
+    return hostname, "lowest 1-minute load (%0.2f%%)" % candidates[hostname]["load"][0]
+
+
+def schedule_weighted_load(config, candidates):
+    scores = dict((h, get_weighted_load(config, c)) for h, c in candidates.items())
+    hostname = min(scores, key=scores.get)
+    return hostname, "lowest weighted load (%0.2f)" % scores[hostname]
+
+
+def schedule_power_of_two(config, candidates):
+    choices = random.sample(sorted(candidates), min(2, len(candidates)))
+    scores = dict((h, get_weighted_load(config, candidates[h])) for h in choices)
+    hostname = min(scores, key=scores.get)
+    return hostname, "lower weighted load of %s" % ", ".join(
+        "'%s' (%0.2f)" % (h, scores[h]) for h in choices)
+
+
+def schedule_weighted_round_robin(config, candidates):
+    # Smooth weighted round-robin: every host gains its capacity, the chosen
+    # host pays back the total.  The running weights are shared between
+    # invocations through the state directory.
+    with locked_state(get_state_path(config, "round_robin.json")) as weights:
+        total = 0.0
+        for h, c in candidates.items():
+            weights[h] = weights.get(h, 0.0) + get_host_capacity(c)
+            total += get_host_capacity(c)
+        hostname = max(sorted(candidates), key=lambda h: weights[h])
+        weights[hostname] -= total
+    return hostname, "weighted round-robin (capacity %s)" % get_host_capacity(candidates[hostname])
+
+
+def schedule_least_sessions(config, candidates):
+    hostname = min(candidates, key=lambda h: (candidates[h]["sessions"] / get_host_capacity(candidates[h]),
+                                              get_weighted_load(config, candidates[h])))
+    return hostname, "fewest active sessions (%d)" % candidates[hostname]["sessions"]
+
+
+# Transcodes that produced less output than this many seconds are too short
+# for their speed to be meaningful
+THROUGHPUT_MIN_OUTPUT = 10.0
+
+def record_throughput(config, hostname, samples):
+    """
+    Adds the average speeds of transcodes on ``hostname`` to the throughput
+    model.  ``samples`` maps the ``PRT_ID`` of each transcode to the host's
+    load when it was placed and its latest ``progress`` record.  A transcode
+    that was sampled before replaces its earlier sample, and only the last
+    ``throughput_samples`` transcodes of each host are kept.
+    """
+    samples = dict((prt_id, (load, progress)) for prt_id, (load, progress) in samples.items()
+                   if progress.get("speed") and progress.get("out_time", 0) >= THROUGHPUT_MIN_OUTPUT)
+    if not samples:
+        return
+
+    window = config.get("throughput_samples", DEFAULT_CONFIG["throughput_samples"])
+    with locked_state(get_state_path(config, "throughput.json")) as model:
+        entry = model.setdefault(hostname, {"samples": []})
+        ids = entry.setdefault("ids", [None] * len(entry["samples"]))
+        for prt_id, (load, progress) in sorted(samples.items()):
+            if prt_id in ids:
+                entry["samples"][ids.index(prt_id)] = [load, progress["speed"]]
+            else:
+                ids.append(prt_id)
+                entry["samples"].append([load, progress["speed"]])
+        del entry["samples"][:-window]
+        del ids[:-window]
+
+
+def sample_throughput(config, servers):
+    """
+    Samples the progress of the transcodes running on ``servers`` and the
+    master into the throughput model, so that it learns while transcodes run
+    instead of each ``prt_remote`` asking its host once the transcode ended.
+    """
+    running = {}
+    for prt_id, placement in read_state(get_state_path(config, "placements.json")).items():
+        if placement["host"] == MASTER_HOST or placement["host"] in servers:
+            running.setdefault(placement["host"], {})[prt_id] = placement.get(
+                "load", placement["base_load"])
+
+    timeout = get_probe_settings(config)[0]
+
+    def sample(hostname):
+        try:
+            if hostname == MASTER_HOST:
+                progress = get_progress_local(config)
+            else:
+                progress = get_progress_remote(config, hostname, servers[hostname], timeout=timeout)
+            record_throughput(config, hostname, dict(
+                (prt_id, (load, progress[prt_id]))
+                for prt_id, load in running[hostname].items() if prt_id in progress))
+        except Exception, e:
+            log.error("Error sampling throughput of host '%s': %s" % (hostname, str(e)))
+
+    threads = []
+    for hostname in running:
+        thread = threading.Thread(target=sample, args=(hostname,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    end = time.time() + timeout + 1
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+
+
+def predict_speed(samples, load):
+    """
+    Predicts the speed of a new transcode at ``load`` from a host's
+    ``[load, speed]`` samples with a least-squares line, or their mean if they
+    don't span enough load.  Returns ``None`` without samples.
+    """
+    if not samples:
+        return None
+
+    n = float(len(samples))
+    mean_load  = sum(l for l, s in samples) / n
+    mean_speed = sum(s for l, s in samples) / n
+    var = sum((l - mean_load) ** 2 for l, s in samples)
+    if len(samples) < 3 or var < 1.0:
+        return mean_speed
+
+    cov = sum((l - mean_load) * (s - mean_speed) for l, s in samples)
+    # More load never makes a host faster, whatever the noise says
+    slope = min(cov / var, 0.0)
+    return max(mean_speed + slope * (load - mean_load), 0.01)
+
+
+def schedule_throughput(config, candidates):
+    model = read_state(get_state_path(config, "throughput.json"))
+    speeds = dict((h, predict_speed(model.get(h, {}).get("samples"), c["load"][0]))
+                  for h, c in candidates.items())
+
+    # Hosts we know nothing about yet get tried first, to learn their speed
+    unknown = [h for h in candidates if speeds[h] is None]
+    if unknown:
+        hostname = min(unknown, key=lambda h: get_weighted_load(config, candidates[h]))
+        return hostname, "no throughput samples yet (weighted load %0.2f)" % (
+            get_weighted_load(config, candidates[hostname]))
+
+    hostname = max(speeds, key=speeds.get)
+    return hostname, "highest predicted speed (%0.2fx at %0.2f%% load)" % (
+        speeds[hostname], candidates[hostname]["load"][0])
+
+
+# Available values for the ``scheduler`` config option
+SCHEDULERS = {
+    "min_load":             schedule_min_load,
+    "weighted_load":        schedule_weighted_load,
+    "power_of_two":         schedule_power_of_two,
+    "weighted_round_robin": schedule_weighted_round_robin,
+    "least_sessions":       schedule_least_sessions,
+    "throughput":           schedule_throughput,
+}
+
+
+def select_host(config, candidates):
+    """
+    Picks a host from ``candidates``, a dict mapping hostnames to dicts with
+    their ``load``, number of active ``sessions`` and ``server`` config, using
+    the configured ``scheduler``.  Returns a tuple ``(hostname, reason)``,
+    where ``hostname`` is ``None`` if there are no candidates.
+    """
+    if not candidates:
+        return None, "no candidates"
+
+    name = config.get("scheduler", DEFAULT_CONFIG["scheduler"])
+    if name not in SCHEDULERS:
+        log.error("Unknown scheduler '%s'...using '%s'" % (name, DEFAULT_CONFIG["scheduler"]))
+        name = DEFAULT_CONFIG["scheduler"]
+
+    hostname, reason = SCHEDULERS[name](config, candidates)
+    return hostname, "%s: %s" % (name, reason)
+
+
+def get_job_features(args):
+    """
+    Returns the features of a transcode used to classify it, as found in the
+    transcoder's arguments ``args``: the ``source`` file, the input
+    ``source_codecs`` Plex asked to decode with, whether there is a
+    ``video_encode`` at all, and the output ``height`` and ``bitrate`` (in
+    kbit/s) if given.
+    """
+    features = {
+        "source":        None,
+        "source_codecs": [],
+        "video_encode":  False,
+        "height":        None,
+        "bitrate":       None
+    }
+
+    seen_input = False
+    for i, arg in enumerate(args[:-1]):
+        value = args[i+1]
+        if arg == "-i":
+            features["source"] = value
+            seen_input = True
+        elif arg.split(":")[0] in CODEC_ARGS:
+            if not seen_input:
+                features["source_codecs"].append(value)
+            elif arg.split(":")[0] in NON_VIDEO_CODEC_ARGS or arg.split(":")[1:2] in (["a"], ["s"]):
+                # -acodec, -scodec, -c:a, -codec:s:0, ... don't encode video
+                pass
+            elif value != "copy" and value not in AUDIO_CODECS and value not in SUBTITLE_CODECS \
+                    and not value.startswith("pcm_"):
+                features["video_encode"] = True
+        elif (arg.split(":")[0] == "-maxrate" or arg == "-b:v") and seen_input:
+            match = BITRATE_RE.match(value)
+            if match:
+                scale = {"": 0.001, "k": 1, "m": 1000}[match.group(2).lower()]
+                features["bitrate"] = max(features["bitrate"], float(match.group(1)) * scale)
+        elif arg in ("-filter_complex", "-vf") or arg.startswith("-filter:"):
+            match = SCALE_RE.search(value)
+            if match and int(match.group(2)) > 0:
+                features["height"] = int(match.group(2))
+        elif arg == "-s" and "x" in value:
+            try:
+                features["height"] = int(value.split("x")[1])
+            except ValueError:
+                pass
+
+    return features
+
+
+def classify_job(config, args):
+    """
+    Returns the first of the ``job_classes`` whose conditions all hold for the
+    transcode with arguments ``args``, or ``None`` if none does.  The
+    conditions a class can have are:
+
+      video_encode      Whether the transcode encodes video
+      source_codecs     The input is decoded with one of these codecs
+      source_patterns   The source path matches one of these (lower case) patterns
+      min_height        The output is at least this many lines high
+      min_bitrate       The output bitrate is at least this many kbit/s
+    """
+    features = get_job_features(args)
+    source = (features["source"] or "").lower()
+
+    for job_class in config.get("job_classes", DEFAULT_CONFIG["job_classes"]):
+        if "video_encode" in job_class and job_class["video_encode"] != features["video_encode"]:
+            continue
+        if "source_codecs" in job_class and \
+                not set(job_class["source_codecs"]) & set(features["source_codecs"]):
+            continue
+        if "source_patterns" in job_class and \
+                not any(fnmatch.fnmatch(source, p) for p in job_class["source_patterns"]):
+            continue
+        if "min_height" in job_class and features["height"] < job_class["min_height"]:
+            continue
+        if "min_bitrate" in job_class and features["bitrate"] < job_class["min_bitrate"]:
+            continue
+        return job_class
+    return None
+
+
+def get_strongest_candidates(candidates):
+    """
+    Returns the candidates with the highest capacity.
+    """
+    if not candidates:
+        return candidates
+    capacity = max(get_host_capacity(c) for c in candidates.values())
+    return dict((h, c) for h, c in candidates.items() if get_host_capacity(c) == capacity)
+
+
+def get_registered_process(pid, started=None):
+    """
+    Returns the ``psutil.Process`` for ``pid`` if it is still running and,
+    when ``started`` is given, is the same process that was registered rather
+    than a later one that reused its PID.
+    """
+    try:
+        proc = psutil.Process(pid)
+        if started is not None and abs(proc.create_time() - started) > 1:
+            return None
+        return proc
+    except psutil.Error:
+        return None
+
+
+def prune_placements(placements):
+    """
+    Removes placements from the ledger whose ``prt_remote`` process has
+    exited without releasing them.  Placements whose ``ssh`` process is still
+    running are left for ``reap_orphans``.
+    """
+    for prt_id, placement in placements.items():
+        if get_registered_process(placement["pid"], placement.get("pid_started")):
+            continue
+        if placement.get("ssh_pid") and get_registered_process(placement["ssh_pid"],
+                                                               placement.get("ssh_started")):
+            continue
+        del placements[prt_id]
+
+
+def register_ssh_process(config, prt_id, proc):
+    """
+    Records the ``ssh`` process spawned for ``prt_id`` in the ledger, which
+    doubles as the registry used by ``reap_orphans``.
+    """
+    try:
+        started = psutil.Process(proc.pid).create_time()
+    except psutil.Error:
+        return
+
+    with locked_state(get_state_path(config, "placements.json")) as placements:
+        if prt_id in placements:
+            placements[prt_id]["ssh_pid"] = proc.pid
+            placements[prt_id]["ssh_started"] = started
+
+
+def reap_orphans(config, timeout=5):
+    """
+    Kills registered ``ssh`` processes whose ``prt_remote`` process has gone
+    away (e.g. it was killed by PMS) and removes their placements.  Only the
+    registry is consulted, so this doesn't need to look at every process on
+    the system.  Returns the number of processes reaped.
+    """
+    orphans = []
+    with locked_state(get_state_path(config, "placements.json")) as placements:
+        for prt_id, placement in placements.items():
+            if get_registered_process(placement["pid"], placement.get("pid_started")):
+                continue
+
+            if placement.get("ssh_pid"):
+                proc = get_registered_process(placement["ssh_pid"], placement.get("ssh_started"))
+                if proc:
+                    orphans.append((prt_id, proc))
+            del placements[prt_id]
+
+    for prt_id, proc in orphans:
+        log.info('Found orphaned PRT process (pid %s, PRT_ID %s)...killing' % (proc.pid, prt_id))
+        try:
+            proc.terminate()
+            proc.wait(timeout)
+        except psutil.TimeoutExpired:
+            proc.kill()
+        except psutil.Error:
+            pass
+
+    if orphans:
+        record_metrics(config, counters=[("prt_reaped_orphans_total", {}, len(orphans))])
+    return len(orphans)
+
+
+def run_reaper(config, interval):
+    """
+    Calls ``reap_orphans`` and ``reap_transcodes`` every ``interval`` seconds
+    until interrupted.
+    """
+    while True:
+        try:
+            reap_orphans(config)
+            reap_transcodes(config)
+        except (IOError, OSError), e:
+            log.error("Error reaping orphans: %s" % str(e))
+        time.sleep(interval)
+
+
+def apply_reservations(config, placements, candidates):
+    """
+    Adds the pending reservations in ``placements`` to the load of each
+    candidate and counts its active sessions.  A reservation is pending until
+    the host's reported load has caught up with it or ``reservation_ttl``
+    seconds have passed.
+    """
+    ttl = config.get("reservation_ttl", DEFAULT_CONFIG["reservation_ttl"])
+    now = time.time()
+
+    reported = {}
+    for hostname, candidate in candidates.items():
+        candidate["sessions"] = 0
+        reported[hostname] = candidate["load"][0]
+
+    for placement in placements.values():
+        hostname = placement["host"]
+        if hostname not in candidates:
+            continue
+
+        candidates[hostname]["sessions"] += 1
+        caught_up = reported[hostname] >= placement["base_load"] + placement["reservation"]
+        if now - placement["time"] < ttl and not caught_up:
+            candidates[hostname]["load"] = [l + placement["reservation"]
+                                            for l in candidates[hostname]["load"]]
+
+
+def apply_slot_limits(config, placements, candidates):
+    """
+    Removes the candidates that already run their ``max_transcodes`` (from
+    their server config, or ``max_transcodes_per_host``), or all of them if
+    the cluster runs ``max_transcodes``.  Must be called after
+    ``apply_reservations``, which counts the sessions.
+    """
+    cluster_max = config.get("max_transcodes", DEFAULT_CONFIG["max_transcodes"])
+    if cluster_max is not None and len(placements) >= cluster_max:
+        log.info("The cluster is running its maximum of %d transcodes" % cluster_max)
+        candidates.clear()
+        return
+
+    host_max = config.get("max_transcodes_per_host", DEFAULT_CONFIG["max_transcodes_per_host"])
+    for hostname, candidate in candidates.items():
+        limit = candidate["server"].get("max_transcodes", host_max)
+        if limit is not None and candidate["sessions"] >= limit:
+            log.debug("Host '%s' is running its maximum of %d transcodes" % (hostname, limit))
+            del candidates[hostname]
+
+
+def get_affinity_host(config, session_id, candidates):
+    """
+    Returns the host that last served ``session_id`` if it is still a
+    candidate, its entry hasn't expired and it isn't overloaded.
+    """
+    if not session_id:
+        return None
+
+    affinity = read_state(get_state_path(config, "affinity.json")).get(session_id)
+    if not affinity:
+        return None
+
+    ttl = config.get("session_affinity_ttl", DEFAULT_CONFIG["session_affinity_ttl"])
+    if time.time() - affinity["time"] > ttl:
+        return None
+
+    hostname = affinity["host"]
+    candidate = candidates.get(hostname)
+    if candidate is None:
+        return None
+
+    max_load = config.get("session_affinity_max_load", DEFAULT_CONFIG["session_affinity_max_load"])
+    if candidate["load"][0] > max_load:
+        log.info("Host '%s' last served session '%s' but is overloaded (%0.2f%%)" % (
+            hostname, session_id, candidate["load"][0]))
+        return None
+
+    return hostname
+
+
+def record_affinity(config, session_id, hostname):
+    """
+    Remembers that ``session_id`` is being served by ``hostname``, dropping
+    expired entries at the same time.
+    """
+    ttl = config.get("session_affinity_ttl", DEFAULT_CONFIG["session_affinity_ttl"])
+    now = time.time()
+    with locked_state(get_state_path(config, "affinity.json")) as affinity:
+        for key, entry in affinity.items():
+            if now - entry["time"] > ttl:
+                del affinity[key]
+        affinity[session_id] = {
+            "host": hostname,
+            "time": now
+        }
+
+
+def reserve_host(config, prt_id, candidates, session_id=None):
+    """
+    Selects a host from ``candidates`` with ``select_host``, taking the
+    placements of concurrent ``prt_remote`` processes into account, and records
+    a reservation for it in the shared ledger.  The ledger is locked for the
+    whole selection, so concurrent starts can't all pick the same host.  A
+    restart of ``session_id`` stays on the host that last served it unless
+    that host is overloaded.
+    """
+    with locked_state(get_state_path(config, "placements.json")) as placements:
+        prune_placements(placements)
+
+        reported = dict((h, c["load"][0]) for h, c in candidates.items())
+        apply_reservations(config, placements, candidates)
+        apply_slot_limits(config, placements, candidates)
+
+        hostname = get_affinity_host(config, session_id, candidates)
+        if hostname is not None:
+            reason = "session affinity for '%s'" % session_id
+        else:
+            hostname, reason = select_host(config, candidates)
+        if hostname is not None:
+            server = candidates[hostname]["server"]
+            placements[prt_id] = {
+                "host":        hostname,
+                "pid":         os.getpid(),
+                "pid_started": psutil.Process().create_time(),
+                "time":        time.time(),
+                "base_load":   reported[hostname],
+                "load":        candidates[hostname]["load"][0],
+                "reservation": server.get("reservation_load",
+                                          config.get("reservation_load", DEFAULT_CONFIG["reservation_load"]))
+            }
+
+    if hostname is not None and session_id:
+        record_affinity(config, session_id, hostname)
+
+    return hostname, reason
+
+
+def copy_candidates(candidates):
+    """
+    Returns a copy of ``candidates`` that ``reserve_host`` can modify.
+    """
+    return dict((h, dict(c, load=list(c["load"]))) for h, c in candidates.items())
+
+
+def wait_for_slot(config, prt_id, candidates, session_id=None):
+    """
+    Waits in a FIFO queue, shared by all ``prt_remote`` processes, until
+    ``reserve_host`` finds a free slot among ``candidates``.  Gives up after
+    ``queue_timeout`` seconds or straight away if ``queue_max_depth`` starts
+    are already waiting.  Returns ``(hostname, reason)`` like
+    ``reserve_host``.
+    """
+    timeout   = config.get("queue_timeout", DEFAULT_CONFIG["queue_timeout"])
+    max_depth = config.get("queue_max_depth", DEFAULT_CONFIG["queue_max_depth"])
+    path = get_state_path(config, "queue.json")
+    start = time.time()
+
+    with locked_state(path) as queue:
+        waiting = queue.setdefault("waiting", [])
+        waiting[:] = [w for w in waiting if get_registered_process(w["pid"], w["pid_started"])]
+        if len(waiting) >= max_depth:
+            return None, "queue is full (%d waiting)" % len(waiting)
+        waiting.append({
+            "id":          prt_id,
+            "pid":         os.getpid(),
+            "pid_started": psutil.Process().create_time(),
+            "time":        start
+        })
+        depth = len(waiting)
+
+    log.info("No free slots...waiting in the queue at position %d" % depth)
+    record_metrics(config, histograms=[("prt_queue_depth", {}, depth)])
+
+    hostname, reason = None, "timed out after %ss in the queue" % timeout
+    try:
+        while hostname is None and time.time() - start < timeout:
+            time.sleep(0.25)
+            with locked_state(path) as queue:
+                waiting = queue.setdefault("waiting", [])
+                waiting[:] = [w for w in waiting
+                              if w["id"] == prt_id or get_registered_process(w["pid"], w["pid_started"])]
+                if waiting[0]["id"] != prt_id:
+                    continue
+                hostname, slot_reason = reserve_host(config, prt_id, copy_candidates(candidates),
+                                                     session_id=session_id)
+                if hostname is not None:
+                    reason = "%s after %0.2fs in the queue" % (slot_reason, time.time() - start)
+    finally:
+        with locked_state(path) as queue:
+            queue["waiting"] = [w for w in queue.get("waiting", []) if w["id"] != prt_id]
+        record_metrics(config, histograms=[("prt_queue_wait_seconds",
+                                            {"outcome": "admitted" if hostname else "timeout"},
+                                            time.time() - start)])
+
+    return hostname, reason
+
+
+def release_host(config, prt_id):
+    """
+    Removes the placement for ``prt_id`` from the ledger once its transcode
+    has finished.
+    """
+    with locked_state(get_state_path(config, "placements.json")) as placements:
+        placements.pop(prt_id, None)
+
+
+def filter_breakers(config, servers):
+    """
+    Returns ``(servers, skipped)``: the hosts in ``servers`` whose circuit
+    breaker allows them to be used, and the names of those it doesn't.  Once
+    its backoff has passed an open breaker goes half-open, letting a single
+    ``prt_remote`` try the host again.
+    """
+    path = get_state_path(config, "breakers.json")
+    now = time.time()
+
+    breakers = read_state(path)
+    if not any(h in breakers for h in servers):
+        return servers, []
+
+    allowed, skipped = {}, []
+    with locked_state(path) as breakers:
+        for hostname, host in servers.items():
+            breaker = breakers.get(hostname)
+            if breaker is None or breaker["state"] == "closed":
+                allowed[hostname] = host
+            elif breaker["retry_at"] <= now:
+                # Give the trial until the next backoff step to report back
+                log.info("Circuit breaker for host '%s' is half-open...trying it again" % hostname)
+                breaker["state"] = "half_open"
+                breaker["retry_at"] = now + breaker["backoff"]
+                allowed[hostname] = host
+            else:
+                skipped.append(hostname)
+    return allowed, sorted(skipped)
+
+
+def record_host_results(config, results, probe=False):
+    """
+    Updates the circuit breakers with ``results``, a dict mapping hostnames to
+    whether using them succeeded.  A success closes the breaker; the
+    ``breaker_threshold``-th consecutive failure, or a failed trial of a
+    half-open breaker, opens it for an exponentially growing backoff.  A
+    successful ``probe`` only closes the breaker without forgetting the
+    failures, as a host can answer probes and still fail transcodes.
+    """
+    threshold   = config.get("breaker_threshold", DEFAULT_CONFIG["breaker_threshold"])
+    backoff     = config.get("breaker_backoff", DEFAULT_CONFIG["breaker_backoff"])
+    max_backoff = config.get("breaker_max_backoff", DEFAULT_CONFIG["breaker_max_backoff"])
+    now = time.time()
+
+    path = get_state_path(config, "breakers.json")
+    if all(results.values()) and not any(h in read_state(path) for h in results):
+        return
+
+    opened = []
+    with locked_state(path) as breakers:
+        for hostname, ok in results.items():
+            if ok:
+                if hostname in breakers and breakers[hostname]["state"] != "closed":
+                    log.info("Circuit breaker for host '%s' is closed" % hostname)
+                if probe and hostname in breakers:
+                    breakers[hostname]["state"] = "closed"
+                else:
+                    breakers.pop(hostname, None)
+                continue
+
+            breaker = breakers.setdefault(hostname, {"state": "closed", "failures": 0, "backoff": 0})
+            breaker["failures"] += 1
+            if breaker["state"] == "half_open" or (breaker["state"] == "closed" and
+                                                   breaker["failures"] >= threshold):
+                breaker["backoff"] = min(max(breaker["backoff"] * 2, backoff), max_backoff)
+                breaker["state"] = "open"
+                breaker["retry_at"] = now + breaker["backoff"]
+                opened.append(hostname)
+                log.info("Circuit breaker for host '%s' is open for %ss after %d failures" % (
+                    hostname, breaker["backoff"], breaker["failures"]))
+
+    if opened:
+        record_metrics(config, counters=[("prt_breaker_opens_total", {"host": h}, 1) for h in opened])
+
+
+# Compiled ``path_mappings`` rules, keyed by their JSON
+PATH_MAPPINGS = {}
+
+# Maps ``(host, path)`` to the path to use on that host
+PATH_CACHE = {}
+
+def compile_path_mappings(rules):
+    """
+    Returns the ``path_mappings`` rules compiled to a list of
+    ``(hosts, prefix, regex, replace)`` tuples.  Each distinct set of rules is
+    only compiled once, and invalid rules are logged and skipped.
+    """
+    key = json.dumps(rules, sort_keys=True)
+    if key not in PATH_MAPPINGS:
+        compiled = []
+        for rule in rules:
+            if not isinstance(rule, dict):
+                log.error("Ignoring path mapping %s: not an object" % json.dumps(rule))
+                continue
+            if not isinstance(rule.get("replace"), basestring):
+                log.error("Ignoring path mapping %s: no 'replace'" % json.dumps(rule))
+                continue
+            if "regex" in rule:
+                try:
+                    regex = re.compile(rule["regex"])
+                except (re.error, TypeError), e:
+                    log.error("Ignoring path mapping %s: invalid regex: %s" % (json.dumps(rule), e))
+                    continue
+            elif isinstance(rule.get("prefix"), basestring) and rule["prefix"]:
+                regex = None
+            else:
+                log.error("Ignoring path mapping %s: no 'prefix' or 'regex'" % json.dumps(rule))
+                continue
+            compiled.append((rule.get("hosts"), rule.get("prefix"), regex, rule["replace"]))
+        PATH_MAPPINGS[key] = compiled
+    return PATH_MAPPINGS[key]
+
+
+def apply_path_mappings(config, host, path):
+    """
+    Returns ``path`` rewritten by the first ``path_mappings`` rule that
+    applies to ``host`` and matches it, or ``None`` if there is no such rule.
+    """
+    rules = compile_path_mappings(config.get("path_mappings", DEFAULT_CONFIG["path_mappings"]))
+    for hosts, prefix, regex, replace in rules:
+        if hosts and host not in hosts:
+            continue
+        if regex is not None:
+            new_path, count = regex.subn(replace, path, 1)
+            if count:
+                return new_path
+        elif path.startswith(prefix) and (prefix.endswith("/") or
+                                          path[len(prefix):len(prefix) + 1] in ("", "/")):
+            # Only whole path components, so "/media" doesn't match "/media2"
+            return replace + path[len(prefix):]
+    return None
+
+
+def run_path_script(config, path):
+    """
+    Runs ``path_script`` once for ``path`` and returns its output, if any.
+    """
+    try:
+        proc = subprocess.Popen([config["path_script"], path], stdout=subprocess.PIPE)
+        output = communicate_with_timeout(proc, config.get("path_script_timeout",
+                                                           DEFAULT_CONFIG["path_script_timeout"]))
+    except OSError, e:
+        log.error("Error calling path_script: %s" % str(e))
+        return None
+
+    if output is None:
+        log.error("path_script timed out for '%s'" % path)
+        return None
+    return output[0].split("\n")[0].strip() or None
+
+
+class PathScriptHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            self.wfile.write((self.server.map(line.rstrip("\n")) or "") + "\n")
+            self.wfile.flush()
+
+
+class PathScriptServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Keeps ``path_script`` running as a co-process that reads one path per line
+    on ``stdin`` and writes the new path (or an empty line) to ``stdout``, and
+    answers ``prt_remote`` over a Unix socket.  Results are memoized.  A
+    co-process that doesn't answer within ``timeout`` seconds is restarted.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, script, timeout):
+        SocketServer.UnixStreamServer.__init__(self, path, PathScriptHandler)
+        self.script         = script
+        self.script_timeout = timeout
+        self.proc           = None
+        self.buf            = ""
+        self.cache          = {}
+        self.lock           = threading.Lock()
+        self.last_used      = time.time()
+
+    def stop_script(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc, self.buf = None, ""
+
+    def read_line(self):
+        """
+        Returns the next line the co-process writes, ``""`` if it exited or
+        ``None`` if it didn't write one within ``timeout`` seconds.
+        """
+        end = time.time() + self.script_timeout
+        fd = self.proc.stdout.fileno()
+        while "\n" not in self.buf:
+            remaining = end - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return None
+            output = os.read(fd, 4096)
+            if not output:
+                return ""
+            self.buf += output
+        line, self.buf = self.buf.split("\n", 1)
+        return line + "\n"
+
+    def map(self, path):
+        with self.lock:
+            self.last_used = time.time()
+            if path not in self.cache:
+                new_path = ""
+                # Restart the co-process once if it has died
+                for attempt in range(2):
+                    if self.proc is None or self.proc.poll() is not None:
+                        self.stop_script()
+                        self.proc = subprocess.Popen([self.script], stdin=subprocess.PIPE,
+                                                     stdout=subprocess.PIPE)
+                    try:
+                        self.proc.stdin.write(path + "\n")
+                        self.proc.stdin.flush()
+                        new_path = self.read_line()
+                    except (IOError, OSError):
+                        new_path = ""
+                    if new_path is None:
+                        # Not cached, the script may well answer next time
+                        log.error("path_script timed out for '%s'...restarting" % path)
+                        self.stop_script()
+                        return None
+                    if new_path:
+                        break
+                    log.error("path_script co-process exited...restarting")
+                    self.stop_script()
+                self.cache[path] = new_path.strip() or None
+            return self.cache[path]
+
+
+def run_path_server(config, idle_timeout=600):
+    """
+    Serves ``path_script`` over the Unix socket in the state directory until
+    it has been idle for ``idle_timeout`` seconds.
+    """
+    sock_path = get_state_path(config, "path_script.sock")
+    if os.path.exists(sock_path):
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(sock_path)
+            sock.close()
+            log.info("path_script server is already running")
+            return
+        except socket.error:
+            os.unlink(sock_path)
+
+    server = PathScriptServer(sock_path, config["path_script"],
+                              config.get("path_script_timeout", DEFAULT_CONFIG["path_script_timeout"]))
+    server.timeout = 10
+    try:
+        while time.time() - server.last_used < idle_timeout:
+            server.handle_request()
+    finally:
+        server.server_close()
+        server.stop_script()
+        os.unlink(sock_path)
+
+
+def query_path_server(config, path):
+    """
+    Asks the ``path_script`` server for the new path of ``path``, starting the
+    server if it isn't running.  Returns ``None`` if it couldn't be reached.
+    """
+    sock_path = get_state_path(config, "path_script.sock")
+    timeout = config.get("path_script_timeout", DEFAULT_CONFIG["path_script_timeout"])
+
+    for attempt in range(2):
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            # The server gives up on the script after ``timeout`` itself, so
+            # leave it time to answer
+            sock.settimeout(timeout + 1)
+            try:
+                sock.connect(sock_path)
+                sock.sendall(path + "\n")
+                return sock.makefile("r").readline().strip() or None
+            finally:
+                sock.close()
+        except socket.timeout:
+            # The server is running, starting another won't help
+            log.error("path_script server timed out for '%s'" % path)
+            break
+        except socket.error:
+            if attempt:
+                break
+
+        prt = find_executable("prt")
+        if not prt:
+            break
+
+        log.info("Starting path_script server")
+        devnull = open(os.devnull, "r+")
+        subprocess.Popen([prt, "path_server"], stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+        devnull.close()
+        for i in range(20):
+            if os.path.exists(sock_path):
+                break
+            time.sleep(0.05)
+
+    log.error("Couldn't reach the path_script server...calling path_script directly")
+    return run_path_script(config, path)
+
+
+def map_path(config, host, path):
+    """
+    Returns the path that ``host`` should use for ``path``.  The
+    ``path_mappings`` rules are tried first and ``path_script`` is only used if
+    none of them match.
+    """
+    key = (host, path)
+    if key not in PATH_CACHE:
+        new_path = apply_path_mappings(config, host, path)
+        if new_path is None and config.get("path_script", None):
+            if config.get("path_script_persistent", DEFAULT_CONFIG["path_script_persistent"]):
+                new_path = query_path_server(config, path)
+            else:
+                new_path = run_path_script(config, path)
+        PATH_CACHE[key] = new_path or path
+    return PATH_CACHE[key]
+
+
+def filter_env(config, environ):
+    """
+    Returns the variables of ``environ`` that match one of the ``env_allow``
+    patterns and none of the ``env_deny`` patterns.
+    """
+    allow = config.get("env_allow", DEFAULT_CONFIG["env_allow"])
+    deny  = config.get("env_deny", DEFAULT_CONFIG["env_deny"])
+    return dict((k, v) for k, v in environ.items()
+                if any(fnmatch.fnmatchcase(k, p) for p in allow)
+                and not any(fnmatch.fnmatchcase(k, p) for p in deny))
+
+
+def build_env(host=None, prt_id=None, config=None, server=None):
+    # TODO: This really should be done in a way that is specific to the target
+    #       in the case that the target is a different architecture than the host
+    ffmpeg_path = os.environ.get("FFMPEG_EXTERNAL_LIBS", "")
+    backslashcheck = re.search(r'\\', ffmpeg_path)
+    if backslashcheck is not None:
+        ffmpeg_path_fixed = ffmpeg_path.replace('\\','')
+        os.environ["FFMPEG_EXTERNAL_LIBS"] = str(ffmpeg_path_fixed)
+
+    if config is None:
+        config = get_config()
+
+    # Not cached: every prt_remote is a new process, so a cache would never
+    # be hit, and filtering the environment is cheap next to the ssh spawn.
+    env = filter_env(config, os.environ)
+
+    # Per-host rewrites, where a value of ``null`` removes the variable
+    for k, v in (server or {}).get("env", {}).items():
+        if v is None:
+            env.pop(k, None)
+        else:
+            env[k] = v
+
+    envs = ["export %s=%s" % (k, pipes.quote(v)) for k, v in sorted(env.items())]
+    envs.append("export PRT_ID=%s" % (prt_id or uuid.uuid1().hex))
+    return ";".join(envs)
+
+
+# def check_gracenote_tmp():
+
+
+
+def get_session_process():
+    """
+    Returns ``(process, over_ssh)``, where ``process`` is the one whose exit
+    means nobody is waiting for this transcode any more.  When run over SSH
+    that is the session's own process, the direct child of ``sshd``: ``sshd``
+    itself can serve many transcodes over one multiplexed connection and
+    outlives each of them.  Otherwise it is the parent process, e.g. PMS.
+    """
+    me = psutil.Process()
+    child, ancestor = me, me.parent()
+    while ancestor is not None and ancestor.pid > 1:
+        if ancestor.name().startswith("sshd"):
+            return child, True
+        child, ancestor = ancestor, ancestor.parent()
+    return me.parent(), False
+
+
+def stdin_hung_up():
+    """
+    Returns ``True`` if ``stdin`` is a terminal whose other end has gone
+    away, i.e. the pty of the SSH session was closed.  Nothing is read from
+    it.
+    """
+    poller = select.poll()
+    try:
+        # Not isatty(), which fails once the pty has been hung up
+        if not stat.S_ISCHR(os.fstat(sys.stdin.fileno()).st_mode):
+            return False
+        poller.register(sys.stdin.fileno(), 0)
+    except (ValueError, IOError, OSError):
+        return False
+    return any(events & (select.POLLHUP | select.POLLERR | select.POLLNVAL)
+               for fd, events in poller.poll(0))
+
+
+def kill_process_tree(proc, timeout=3):
+    """
+    Terminates ``proc`` and all of its descendants, killing whatever is still
+    alive after ``timeout`` seconds.
+    """
+    try:
+        procs = proc.children(recursive=True) + [proc]
+    except psutil.Error:
+        return
+
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.Error:
+            pass
+
+    gone, alive = psutil.wait_procs(procs, timeout=timeout)
+    for p in alive:
+        try:
+            p.kill()
+        except psutil.Error:
+            pass
+
+
+def register_transcode(config, prt_id, proc, session):
     """
-    Gets the result from ``get_system_load_local`` of a remote machine.
+    Records a transcode started by ``transcode_local`` in the registry of this
+    host, together with the session process it belongs to.
     """
-    proc = subprocess.Popen(["ssh", "%s@%s" % (user, host), "-p", port, "prt", "get_load"], stdout=subprocess.PIPE)
-    proc.wait()
-    return [float(i) for i in proc.stdout.read().strip().split()]
+    with locked_state(get_state_path(config, "transcodes.json")) as transcodes:
+        transcodes[prt_id] = {
+            "pid":             os.getpid(),
+            "pid_started":     psutil.Process().create_time(),
+            "child":           proc.pid,
+            "child_started":   psutil.Process(proc.pid).create_time(),
+            "session":         session.pid,
+            "session_started": session.create_time(),
+            "time":            time.time()
+        }
 
 
-def setup_logging():
-    config = get_config()
-    logging.config.dictConfig(config["logging"])
+def unregister_transcode(config, prt_id):
+    with locked_state(get_state_path(config, "transcodes.json")) as transcodes:
+        transcodes.pop(prt_id, None)
 
 
-def get_transcoder_path(name=NEW_TRANSCODER_NAME):
+def reap_transcodes(config):
     """
-    Returns the full path to ``name`` located in ``TRANSCODER_DIR``.
+    Kills registered transcodes whose session process or ``prt_local`` process
+    has gone away, e.g. because the master's ``ssh`` died.  Returns the number
+    of transcodes reaped.
     """
-    return os.path.join(TRANSCODER_DIR, name)
-
-
-def rename_transcoder():
+    reaped = []
+    with locked_state(get_state_path(config, "transcodes.json")) as transcodes:
+        for prt_id, entry in transcodes.items():
+            owner = get_registered_process(entry["pid"], entry["pid_started"])
+            child = get_registered_process(entry["child"], entry["child_started"])
+            if owner is None:
+                if child is not None:
+                    reaped.append((prt_id, child, "owner"))
+                del transcodes[prt_id]
+            elif get_registered_process(entry["session"], entry["session_started"]) is None:
+                reaped.append((prt_id, owner, "session"))
+                del transcodes[prt_id]
+
+    for prt_id, proc, reason in reaped:
+        log.info("The %s of transcode %s is gone...killing pid %s" % (reason, prt_id, proc.pid))
+        kill_process_tree(proc)
+
+    if reaped:
+        record_metrics(config, counters=[("prt_reaped_transcodes_total", {"reason": r}, 1)
+                                         for prt_id, proc, r in reaped])
+    return len(reaped)
+
+
+def watch_session(config, prt_id, proc, session, over_ssh, stopped):
     """
-    Moves the original transcoder "Plex Transcoder" to the new name given
-    by ``TRANSCODER_NAME``.
+    Kills the transcoder ``proc`` as soon as ``session`` exits, this process
+    is orphaned or, if ``over_ssh``, the SSH session's pty is hung up, rather
+    than letting it run to completion.  Returns once ``stopped`` is set.
     """
-    old_path = get_transcoder_path(ORIGINAL_TRANSCODER_NAME)
-    new_path = get_transcoder_path(NEW_TRANSCODER_NAME)
-
-    if os.path.exists(new_path):
-        print "Transcoder appears to have been renamed previously...not renaming (try overwrite option)"
-        return False
-
-    try:
-        os.rename(old_path, new_path)
-    except Exception, e:
-        print "Error renaming original transcoder: %s" % str(e)
-        return False
-
-    return True
-
+    interval = config.get("watchdog_interval", DEFAULT_CONFIG["watchdog_interval"])
+    while not stopped.wait(interval):
+        # The session process may be this one, if the remote shell exec'd
+        # prt_local, so a hung up pty also means the session is gone.  Not
+        # when run by PMS, whose terminal has nothing to do with the transcode.
+        if not session.is_running() or os.getppid() == 1 or (over_ssh and stdin_hung_up()):
+            log.info("Session of transcode %s is gone...killing pid %s" % (prt_id, proc.pid))
+            try:
+                kill_process_tree(psutil.Process(proc.pid))
+            except psutil.Error:
+                pass
+            record_metrics(config, counters=[("prt_reaped_transcodes_total", {"reason": "watchdog"}, 1)])
+            return
+
+
+def parse_timestamp(value):
+    """
+    Returns the number of seconds in an ffmpeg ``HH:MM:SS.ms`` timestamp.
+    """
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
 
-def install_transcoder():
-    prt_remote = find_executable("prt_remote")
-    if not prt_remote:
-        print "Couldn't find `prt_remote` executable"
-        return
 
-    print "Renaming original transcoder"
-    if rename_transcoder():
+def parse_progress(line, progress):
+    """
+    Updates ``progress`` with the fields found in a line of transcoder output.
+    Returns ``True`` if any were found.
+    """
+    found = False
+    for key, value in PROGRESS_RE.findall(line):
         try:
-            shutil.copyfile(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME))
-            os.chmod(get_transcoder_path(ORIGINAL_TRANSCODER_NAME), 0755)
-        except Exception, e:
-            print "Error installing new transcoder: %s" % str(e)
+            if key == "frame":
+                progress["frame"] = int(value)
+            elif key == "fps":
+                progress["fps"] = float(value)
+            elif key == "speed":
+                progress["speed"] = float(value.rstrip("x"))
+            elif key == "bitrate":
+                progress["bitrate"] = float(value.split("kbits/s")[0])
+            else:
+                progress["out_time"] = parse_timestamp(value)
+            found = True
+        except ValueError:
+            # e.g. "N/A" before the first frame has been written
+            pass
+    return found
 
 
-# Overwrite_transcoder_after_upgrade function
-def overwrite_transcoder_after_upgrade():
+def write_progress(config, prt_id, progress):
     """
-    Moves the upgraded transcoder "Plex Transcoder" to the new name given
-    by ``TRANSCODER_NAME`` if the plex package has overwritten the old one.
+    Stores the latest ``progress`` of transcode ``prt_id`` in the progress
+    file of this host, dropping records that haven't been updated for
+    ``progress_ttl`` seconds.
     """
-    old_path = get_transcoder_path(ORIGINAL_TRANSCODER_NAME)
-    new_path = get_transcoder_path(NEW_TRANSCODER_NAME)
+    ttl = config.get("progress_ttl", DEFAULT_CONFIG["progress_ttl"])
+    now = time.time()
+    try:
+        with locked_state(get_state_path(config, "progress.json")) as records:
+            for key, record in records.items():
+                if record.get("updated", 0) < now - ttl:
+                    del records[key]
+            records[prt_id] = dict(progress, updated=now)
+    except (IOError, OSError), e:
+        log.error("Error writing progress: %s" % str(e))
 
-    prt_remote = find_executable("prt_remote")
-    if not prt_remote:
-        print "Couldn't find `prt_remote` executable"
-        sys.exit(2)
-    elif os.path.exists(new_path):
-           print "Transcoder appears to have been renamed previously...checking if it's been overwritten"
-           if not filecmp.cmp(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME), shallow=1):
-               try:
-                   shutil.copyfile(prt_remote, get_transcoder_path(ORIGINAL_TRANSCODER_NAME))
-                   os.chmod(get_transcoder_path(ORIGINAL_TRANSCODER_NAME), 0755)
-               except Exception, e:
-                   print "Error installing new transcoder: %s" % str(e)
-                   sys.exit(2)
-           else:
-               print "Transcoder hasn't been overwritten by upgrade, nothing to do"
-               sys.exit(1)
-    else:
-         print "Transcoder hasn't been previously installed, please use install option"
-         sys.exit(1)
 
-def build_env(host=None):
-    # TODO: This really should be done in a way that is specific to the target
-    #       in the case that the target is a different architecture than the host
-    ffmpeg_path = os.environ.get("FFMPEG_EXTERNAL_LIBS", "")
-    backslashcheck = re.search(r'\\', ffmpeg_path)
-    if backslashcheck is not None:
-        ffmpeg_path_fixed = ffmpeg_path.replace('\\','')
-        os.environ["FFMPEG_EXTERNAL_LIBS"] = str(ffmpeg_path_fixed)
+def get_progress_local(config, prt_id=None):
+    """
+    Returns the progress records of the transcodes on this host, keyed by
+    ``PRT_ID``, or only that of ``prt_id`` if given.
+    """
+    records = read_state(get_state_path(config, "progress.json"))
+    if prt_id:
+        return dict((k, v) for k, v in records.items() if k == prt_id)
+    return records
 
-    envs = ["export %s=%s" % (k, pipes.quote(v)) for k,v in os.environ.items()]
-    envs.append("export PRT_ID=%s" % uuid.uuid1().hex)
-    return ";".join(envs)
 
+def get_progress_remote(config, hostname, host, prt_id=None, timeout=None):
+    """
+    Returns ``get_progress_local`` of a transcode host, asking its ``prt
+    agent`` if it runs one and falling back to SSH.
+    """
+    command = "progress %s" % prt_id if prt_id else "progress"
+    if host.get("agent_port"):
+        try:
+            return query_agent(hostname, host["agent_port"], command, timeout=timeout)
+        except (socket.error, ValueError), e:
+            log.debug("Couldn't query agent on host '%s': %s" % (hostname, str(e)))
 
-# def check_gracenote_tmp():
+    args = ssh_command(hostname, host["port"], host["user"], config=config,
+                       timeout=timeout) + ["prt"] + command.split()
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        log.error("Error getting progress from host '%s': %s" % (hostname, str(e)))
+        return {}
 
+    output = communicate_with_timeout(proc, timeout)
+    try:
+        return json.loads(output[0]) if output else {}
+    except ValueError:
+        return {}
 
 
 def transcode_local():
     setup_logging()
+    try:
+        start = psutil.Process().create_time()
+    except psutil.Error:
+        start = time.time()
 
     # The transcoder needs to have the propery LD_LIBRARY_PATH
     # set, otherwise it cannot run
@@ -274,6 +2434,10 @@ def transcode_local():
     config = get_config()
     is_debug = config['logging']['loggers']['prt']['level'] == 'DEBUG'
 
+    prt_id = os.environ.get("PRT_ID") or uuid.uuid1().hex
+    trace = Trace(config, "local", prt_id, start=start)
+    trace.record["spans"].append({"name": "startup", "offset": 0, "duration": time.time() - start})
+
     if is_debug:
         log.info('Debug mode - enabling verbose ffmpeg output')
 
@@ -284,106 +2448,131 @@ def transcode_local():
             elif arg == '-loglevel_plex':
                 sys.argv[i+1] = 'verbose'
 
-    # Set up the arguments
+    # Set up the arguments.  Plex usually turns the status lines off with
+    # -loglevel, so ask for "key=value" progress reports on stderr as well,
+    # whatever the log level.
     args = [get_transcoder_path()] + sys.argv[1:]
+    if "-progress" not in args:
+        args[1:1] = ["-progress", "pipe:2"]
 
     log.info("Launching transcode_local: %s\n" % args)
 
     # Spawn the process
-    proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+    start = time.time()
+    with trace.span("spawn"):
+        try:
+            proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+        except OSError, e:
+            log.error("Couldn't start the transcoder '%s': %s" % (args[0], str(e)))
+            proc = None
+    trace.write()
 
-    while True:
-        output = proc.stderr.readline()
-        if output == '' and proc.poll() is not None:
-            break
-        if output and is_debug:
-            log.debug(output.strip('\n'))
+    if proc is None:
+        record_metrics(config, counters=[("prt_transcode_exits_total",
+                                          {"host": "local", "code": SPAWN_FAILED}, 1)])
+        return SPAWN_FAILED
 
-def transcode_remote():
-    setup_logging()
+    try:
+        session, over_ssh = get_session_process()
+        register_transcode(config, prt_id, proc, session)
+    except psutil.Error, e:
+        log.error("Couldn't register transcode %s: %s" % (prt_id, str(e)))
+        session = None
+
+    stopped = threading.Event()
+    if session is not None:
+        watchdog = threading.Thread(target=watch_session,
+                                    args=(config, prt_id, proc, session, over_ssh, stopped))
+        watchdog.daemon = True
+        watchdog.start()
+
+    interval = config.get("progress_interval", DEFAULT_CONFIG["progress_interval"])
+    progress, written, buf = {}, 0, ""
+    try:
+        while True:
+            # ffmpeg ends its status lines with "\r", so split on that too
+            output = os.read(proc.stderr.fileno(), 4096)
+            if not output:
+                break
+            lines = re.split(r"[\r\n]", buf + output)
+            buf = lines.pop()
+            for line in lines:
+                if line and is_debug:
+                    log.debug(line)
+                if parse_progress(line, progress) and time.time() - written >= interval:
+                    write_progress(config, prt_id, progress)
+                    written = time.time()
+        proc.wait()
+    finally:
+        if session is not None:
+            stopped.set()
+            watchdog.join()
+            unregister_transcode(config, prt_id)
 
-    log.info("Checking for orphaned PRT processes")
-    found = 0
-    for proc in psutil.process_iter():
-        try:
-            if proc.name == "ssh" and 'PLEX_MEDIA_SERVER' in ' '.join(proc.cmdline):
-                if proc.parent.pid == 1:
-                    log.info('Found orphaned PRT process (pid %s)...killing' % proc.pid)
-                    found += 1
-                    proc.terminate()
-                    proc.wait()
-        except psutil.NoSuchProcess:
-            pass
+    if buf:
+        parse_progress(buf, progress)
+    progress["exit"] = proc.returncode
+    write_progress(config, prt_id, progress)
 
-    log.info("Found %d orphaned PRT processes" % found)
+    record_metrics(config,
+        counters=[("prt_transcode_exits_total", {"host": "local", "code": proc.returncode}, 1)],
+        histograms=[("prt_transcode_duration_seconds", {"host": "local"}, time.time() - start)])
+
+    # Also when the watchdog killed it, so that prt_remote sees the failure
+    return proc.returncode
+
+def transcode_remote():
+    setup_logging()
+    start = time.time()
 
     config = get_config()
     args   = sys.argv[1:]
-
+    prt_id = uuid.uuid1().hex
+    trace  = Trace(config, "remote", prt_id, start=start)
 
     # FIX: This is (temporary?) fix for the EasyAudioEncoder (EAE) which uses a
     #      hardcoded path in /tmp.  If we find that EAE is being used then we
     #      force transcoding on the master
-    if 'eae_prefix' in ' '.join(args):
+    with trace.span("eae_check"):
+        use_eae = 'eae_prefix' in ' '.join(args)
+
+    if use_eae:
         log.info("Found EAE is being used...forcing local transcode")
+        record_metrics(config, counters=[("prt_local_fallbacks_total", {"reason": "eae"}, 1)])
+        trace.write(host="local")
+        os.environ["PRT_ID"] = prt_id
         return transcode_local()
 
-    # Check to see if we need to call a user-script to replace/modify the file path
-    if config.get("path_script", None):
-        idx = 0
-        # The file path comes after the "-i" command line argument
-        for i, v in enumerate(args):
-            if v == "-i":
-                idx = i+1
-                break
-
-        # Found the requested video path
-        path = args[idx]
-
-        try:
-            proc = subprocess.Popen([config.get("path_script"), path], stdout=subprocess.PIPE)
-            proc.wait()
-            new_path = proc.stdout.readline().strip()
-            if new_path:
-                log.debug("Replacing path with: %s" % new_path)
-                args[idx] = new_path
-        except Exception, e:
-            log.error("Error calling path_script: %s" % str(e))
-
-    command = REMOTE_ARGS % {
-        "env":          build_env(),
-        "working_dir":  pipes.quote(os.getcwd()),
-        "command":      "prt_local",
-        "args":         ' '.join([pipes.quote(a) for a in args])
-    }
-
-    servers = config["servers"]
+    with trace.span("classify"):
+        job_class = classify_job(config, args) or {}
+        placement = job_class.get("placement", "schedule")
+    if job_class:
+        log.info("Transcode is of class '%s' (%s)" % (job_class.get("name"), placement))
+        trace.record["job_class"] = job_class.get("name")
+
+    if placement == "local":
+        record_metrics(config, counters=[("prt_local_fallbacks_total", {"reason": "job_class"}, 1)])
+        trace.write(host="local")
+        os.environ["PRT_ID"] = prt_id
+        return transcode_local()
 
-    # Look to see if we need to run an external script to get hosts
-    if config.get("servers_script", None):
-        try:
-            proc = subprocess.Popen([config["servers_script"]], stdout=subprocess.PIPE)
-            proc.wait()
+    with trace.span("servers_script"):
+        servers = get_servers(config)
 
-            servers = {}
-            for line in proc.stdout.readlines():
-                hostname, port, user = line.strip().split()
-                servers[hostname] = {
-                    "port": port,
-                    "user": user
-                }
-        except Exception, e:
-            log.error("Error retreiving host list via '%s': %s" % (config["servers_script"], str(e)))
+    servers, skipped = filter_breakers(config, servers)
+    if skipped:
+        log.info("Skipping hosts with an open circuit breaker: %s" % ", ".join(skipped))
 
     hostname, host = None, None
 
     # Let's try to load-balance
-    min_load = None
-    for hostname, host in servers.items():
-
-        log.debug("Getting load for host '%s'" % hostname)
-        load = get_system_load_remote(hostname, host["port"], host["user"])
+    with trace.span("load_probe"):
+        loads, missed = get_cached_loads(config, servers)
+    if missed:
+        log.info("Hosts that missed the probe deadline: %s" % ", ".join(sorted(missed)))
 
+    candidates = {}
+    for hostname, load in loads.items():
         if not load:
             # If no load is returned, then it is likely that the host
             # is offline or unreachable
@@ -391,38 +2580,157 @@ def transcode_remote():
             continue
 
         log.debug("Log for '%s': %s" % (hostname, str(load)))
+        candidates[hostname] = {
+            "load":   load,
+            "server": servers[hostname]
+        }
+
+    if config.get("master_candidate", DEFAULT_CONFIG["master_candidate"]):
+        # The headroom keeps some of the master free for PMS itself
+        headroom = config.get("master_headroom", DEFAULT_CONFIG["master_headroom"])
+        candidates[MASTER_HOST] = {
+            "load":   [l + headroom for l in get_system_load_local()],
+            "server": {"capacity": config.get("master_capacity", DEFAULT_CONFIG["master_capacity"])}
+        }
 
-        # XXX: Use more that just 1-minute load?
-        if min_load is None or min_load[1] > load[0]:
-            min_load = (hostname, load[0],)
+    session_id = re_get(SESSION_RE, ' '.join(args))
+    budget = config.get("failover_budget", DEFAULT_CONFIG["failover_budget"])
+    window = config.get("failover_window", DEFAULT_CONFIG["failover_window"])
+    path = args[args.index("-i") + 1] if "-i" in args[:-1] else None
+    failed = []
 
-    if min_load is None:
-        log.info("No hosts found...using local")
-        return transcode_local()
+    while True:
+        # ``reserve_host`` adds the pending reservations to the loads it is
+        # given, so every attempt starts from the probed loads
+        pool = get_strongest_candidates(candidates) if placement == "strongest" else candidates
+        attempt = copy_candidates(pool)
+        # Nothing carries over from a failed attempt
+        hostname, reason, queued = None, "no candidates", None
+        with trace.span("select"):
+            if pool:
+                # Later starts queue up behind the ones already waiting for a slot
+                queued = read_state(get_state_path(config, "queue.json")).get("waiting")
+                if not queued:
+                    hostname, reason = reserve_host(config, prt_id, attempt, session_id=session_id)
+
+        if pool and (queued or hostname is None):
+            with trace.span("queue"):
+                hostname, reason = wait_for_slot(config, prt_id, pool, session_id=session_id)
+            if hostname is None:
+                log.info("No free slots (%s)...using local" % reason)
+                record_metrics(config, counters=[("prt_local_fallbacks_total", {"reason": "queue"}, 1)])
+                trace.write(host="local")
+                os.environ["PRT_ID"] = prt_id
+                return transcode_local()
+            attempt = copy_candidates(pool)
+
+        if hostname is None:
+            log.info("No hosts found...using local")
+            record_metrics(config, counters=[("prt_local_fallbacks_total",
+                                              {"reason": "failover" if failed else "no_hosts"}, 1)])
+            trace.write(host="local")
+            os.environ["PRT_ID"] = prt_id
+            return transcode_local()
+
+        log.info("Selected host '%s' (%s)" % (hostname, reason))
+        record_metrics(config,
+            counters=[("prt_placements_total", {"host": hostname}, 1)],
+            histograms=[("prt_host_selection_seconds", {}, time.time() - start)])
+
+        if hostname == MASTER_HOST:
+            # No ssh hop, tunnel or path mapping needed for the master
+            trace.write(host="local")
+            os.environ["PRT_ID"] = prt_id
+            try:
+                returncode = transcode_local()
+            finally:
+                release_host(config, prt_id)
+
+            # Nothing to wait for here, the record is a local file
+            if config.get("scheduler", DEFAULT_CONFIG["scheduler"]) == "throughput":
+                record_throughput(config, hostname, {prt_id: (
+                    attempt[hostname]["load"][0], get_progress_local(config, prt_id).get(prt_id, {}))})
+            return returncode
+
+        host = servers[hostname]
+
+        log.info("Using transcode host '%s'" % hostname)
+
+        # Check to see if we need to replace/modify the file path, which comes
+        # after the "-i" command line argument
+        if path is not None:
+            with trace.span("path_mapping"):
+                idx = args.index("-i") + 1
+                args[idx] = map_path(config, hostname, path)
+                if args[idx] != path:
+                    log.debug("Replacing path with: %s" % args[idx])
+
+        with trace.span("build_env"):
+            command = REMOTE_ARGS % {
+                "env":          build_env(hostname, prt_id=prt_id, config=config, server=host),
+                "working_dir":  pipes.quote(os.getcwd()),
+                "command":      "prt_local",
+                "args":         ' '.join([pipes.quote(a) for a in args])
+            }
 
-    # Select lowest-load host
-    log.info("Host with minimum load is '%s'" % min_load[0])
-    hostname, host = min_load[0], servers[min_load[0]]
+        # Remap the 127.0.0.1 reference to the proper address
+        #command = command.replace("127.0.0.1", config["ipaddress"])
 
-    log.info("Using transcode host '%s'" % hostname)
+        #
+        # TODO: Remap file-path to PMS URLs
+        #
 
-    # Remap the 127.0.0.1 reference to the proper address
-    #command = command.replace("127.0.0.1", config["ipaddress"])
+        with trace.span("ssh_spawn"):
+            ssh_args = ssh_command(hostname, host["port"], host["user"], config=config,
+                                   timeout=get_probe_settings(config)[0])
+            ssh_args = ssh_args[:1] + ["-tt", "-R", "32400:127.0.0.1:32400"] + ssh_args[1:] + [command]
 
-    #
-    # TODO: Remap file-path to PMS URLs
-    #
+            log.info("Launching transcode_remote with args %s\n" % ssh_args)
 
-    args = ["ssh", "-tt", "-R", "32400:127.0.0.1:32400", "%s@%s" % (host["user"], hostname), "-p", host["port"]] + [command]
+            # Spawn the process
+            spawned = time.time()
+            try:
+                proc = subprocess.Popen(ssh_args)
+            except:
+                release_host(config, prt_id)
+                raise
+            register_ssh_process(config, prt_id, proc)
+        trace.write(host=hostname)
 
+        try:
+            proc.wait()
+        finally:
+            release_host(config, prt_id)
+
+        log.info("Transcode stopped on host '%s'" % hostname)
+        record_metrics(config,
+            counters=[("prt_transcode_exits_total", {"host": hostname, "code": proc.returncode}, 1)],
+            histograms=[("prt_transcode_duration_seconds", {"host": hostname}, time.time() - spawned)])
+
+        # A transcode that couldn't be started right away (e.g. ssh couldn't
+        # connect or prt_local is broken) is retried on the next-best host, or
+        # locally if there is none, as long as there is time left in the
+        # budget.  The transcoder's own errors, e.g. for a corrupt file, would
+        # fail the same way anywhere, so they are passed straight through.
+        if proc.returncode not in LAUNCH_FAILURES or time.time() - spawned >= window:
+            record_host_results(config, {hostname: True})
+            break
 
-    log.info("Launching transcode_remote with args %s\n" % args)
+        record_host_results(config, {hostname: False})
+        if time.time() - start >= budget:
+            log.error("Transcode couldn't start on host '%s' (code %d)...out of failover budget" % (
+                hostname, proc.returncode))
+            break
 
-    # Spawn the process
-    proc = subprocess.Popen(args)
-    proc.wait()
+        log.info("Transcode couldn't start on host '%s' (code %d)...failing over" % (
+            hostname, proc.returncode))
+        record_metrics(config, counters=[("prt_failovers_total", {"host": hostname}, 1)])
+        del candidates[hostname]
+        failed.append(hostname)
+        prt_id = uuid.uuid1().hex
+        trace = Trace(config, "remote", prt_id)
 
-    log.info("Transcode stopped on host '%s'" % hostname)
+    return proc.returncode
 
 
 def re_get(regex, string, group=0, default=None):
@@ -441,105 +2749,341 @@ def et_get(node, attrib, default=None):
     return default
 
 
+def parse_plex_sessions(fh):
+    """
+    Parses a ``/status/sessions`` response from ``fh`` incrementally, clearing
+    each item once it has been handled so the whole document is never held in
+    memory.  Returns a dict mapping transcode session keys to session info.
+    """
+    sessions = {}
+    for event, node in ET.iterparse(fh):
+        if node.tag == "Video":
+            session_id = et_get(node.find('.//TranscodeSession'), 'key')
+            if session_id:
+                sessions[session_id] = {
+                    'file':     et_get(node.find('.//Media/Part'), 'file'),
+                    'progress': et_get(node.find('.//TranscodeSession'), 'progress')
+                }
+            node.clear()
+        elif node.tag in ("Track", "Photo"):
+            node.clear()
+    return sessions
+
+
 def get_plex_sessions(auth_token=None):
     url = 'http://localhost:32400/status/sessions'
     if auth_token:
         url += "?X-Plex-Token=%s" % auth_token
 
-    res = urllib.urlopen(url)
-    dom = ET.parse(res)
-    sessions = {}
-    for node in dom.findall('.//Video'):
-        session_id = et_get(node.find('.//TranscodeSession'), 'key')
-        if session_id:
-            sessions[session_id] = {
-                'file': et_get(node.find('.//Media/Part'), 'file')
-        }
-    return sessions
+    return parse_plex_sessions(urllib.urlopen(url))
 
-def get_sessions():
-    sessions = {}
 
-    config = get_config()
+def iter_processes(attrs):
+    """
+    Yields ``(proc, info)`` for every process, where ``info`` is a dict of the
+    requested ``attrs``.  Newer versions of ``psutil`` prefetch these in a
+    single pass.
+    """
+    try:
+        procs = psutil.process_iter(attrs=attrs)
+    except TypeError:
+        # psutil < 5.3
+        procs = None
+
+    if procs is not None:
+        for proc in procs:
+            yield proc, proc.info
+        return
+
+    for proc in psutil.process_iter():
+        try:
+            yield proc, proc.as_dict(attrs)
+        except psutil.Error:
+            pass
+
+
+def inspect_prt_process(proc, name, ppid):
+    """
+    Returns ``(prt_id, pinfo)`` if ``proc`` is an ``ssh`` process started by
+    ``transcode_remote``, otherwise ``None``.  The command line and parent name
+    are only looked up for ``ssh`` processes.
+    """
+    if name != 'ssh':
+        return None
+
+    try:
+        pinfo = {'name': name, 'ppid': ppid, 'cmdline': proc.cmdline()}
+    except psutil.Error:
+        return None
+
+    m = PRT_ID_RE.search(' '.join(pinfo['cmdline']))
+    if not m:
+        return None
+
+    # Check the parent to make sure it is the "Plex Transcoder"
+    try:
+        parent_name = psutil.Process(ppid).name()
+    except psutil.Error:
+        return None
+
+    if parent_name and 'plex' in parent_name.lower():
+        return m.groups()[0], pinfo
+    return None
+
+
+def iter_prt_processes():
+    """
+    Yields ``(prt_id, pinfo)`` for every ``ssh`` process started by
+    ``transcode_remote``.  Only the name and parent PID are read for all
+    processes.
+    """
+    for proc, pinfo in iter_processes(['name', 'ppid']):
+        found = inspect_prt_process(proc, pinfo['name'], pinfo['ppid'])
+        if found:
+            yield found
+
+
+def get_plex_auth_token(config):
+    """
+    Returns the Plex auth token from ``config``, asking for credentials (and
+    saving the token) if there isn't one yet.
+    """
     if config.get('auth_token') == None:
         config['auth_token'] = get_auth_token()
         if not config['auth_token']:
-            return sessions
+            return None
         save_config(config)
+    return config['auth_token']
+
+
+def get_session_data(pinfo, plex_sessions):
+    """
+    Combines the ``ssh`` process info of a PRT session with its Plex session
+    and transcode host.
+    """
+    cmdline = ' '.join(pinfo['cmdline'])
+    session_id = re_get(SESSION_RE, cmdline)
+    data = {
+        'proc': pinfo,
+        'plex': plex_sessions.get(session_id, {}),
+        'host': {}
+    }
+
+    host = re_get(SSH_HOST_RE, cmdline, 'all')
+    if host:
+        data['host'] = {
+            'user':    host[0],
+            'address': host[1]
+        }
+    return data
+
 
+def get_sessions():
     sessions = {}
 
-    plex_sessions = get_plex_sessions(auth_token=config['auth_token'])
-    for proc in psutil.process_iter():
-        parent_name = None
+    auth_token = get_plex_auth_token(get_config())
+    if not auth_token:
+        return sessions
+
+    plex_sessions = get_plex_sessions(auth_token=auth_token)
+    for prt_id, pinfo in iter_prt_processes():
+        sessions[prt_id] = get_session_data(pinfo, plex_sessions)
+    return sessions
+
+
+def watch_sessions(interval=2.0):
+    """
+    Redraws a table of all sessions every ``interval`` seconds until
+    interrupted.  State is kept between refreshes: only processes that have
+    appeared since the last refresh are inspected, while Plex sessions and host
+    loads are refreshed by a background poller.
+    """
+    config = get_config()
+    auth_token = get_plex_auth_token(config)
+    if not auth_token:
+        return
+
+    polled = {'plex': {}, 'loads': {}}
+
+    def poll():
+        while True:
+            try:
+                polled['plex'] = get_plex_sessions(auth_token=auth_token)
+            except Exception, e:
+                log.debug("Error getting Plex sessions: %s" % str(e))
+            polled['loads'] = get_cached_loads(config, get_servers(config))[0]
+            time.sleep(interval)
+
+    poller = threading.Thread(target=poll)
+    poller.daemon = True
+    poller.start()
+
+    # PID to ``(prt_id, pinfo)`` for PRT processes, ``None`` for the rest
+    known = {}
+    while True:
+        start = time.time()
+
+        pids = set(psutil.pids())
+        for pid in set(known) - pids:
+            del known[pid]
+
+        for pid in pids - set(known):
+            try:
+                proc = psutil.Process(pid)
+                found = inspect_prt_process(proc, proc.name(), proc.ppid())
+                # A freshly forked process may not have exec'd ssh yet
+                if found is None and time.time() - proc.create_time() < 1:
+                    continue
+            except psutil.Error:
+                continue
+            known[pid] = found
+
+        sessions = [get_session_data(pinfo, polled['plex'])
+                    for prt_id, pinfo in sorted(filter(None, known.values()))]
+        elapsed = time.time() - start
+
+        sys.stdout.write("\x1b[2J\x1b[H")
+        print "PRT sessions at %s (refreshed in %0.1f ms)\n" % (time.strftime("%H:%M:%S"), elapsed*1000)
+        print "  %-20s %-15s %8s  %-20s %s" % ("Session", "Host", "Progress", "Host Load", "File")
+        for session in sessions:
+            address = session['host'].get('address')
+            load = polled['loads'].get(address)
+            progress = session['plex'].get('progress')
+            print "  %-20s %-15s %8s  %-20s %s" % (
+                re_get(SESSION_RE, ' '.join(session['proc']['cmdline'])),
+                address,
+                "%0.1f%%" % float(progress) if progress else "-",
+                ", ".join("%0.0f%%" % l for l in load) if load else "unknown",
+                session['plex'].get('file') or "-")
+        sys.stdout.flush()
+
+        time.sleep(max(0, interval - elapsed))
+
+
+def check_paths_local(paths):
+    """
+    Returns the owner and mode of each of ``paths`` on this machine, or the
+    error that prevented reading them.
+    """
+    results = {}
+    for path in paths:
         try:
-            if callable(proc.parent):
-                parent_name = proc.parent().name()
-            else:
-                parent_name = proc.parent.name
-        except:
+            st = os.stat(path)
+        except OSError, e:
+            results[path] = {"error": e.strerror}
             continue
+        try:
+            user = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            user = str(st.st_uid)
+        results[path] = {"user": user, "mode": "%o" % (st.st_mode & 07777)}
+    return results
 
-        if not parent_name:
-            continue
 
-        pinfo = proc.as_dict(['name', 'cmdline'])
-
-        # Check the parent to make sure it is the "Plex Transcoder"
-        if pinfo['name'] == 'ssh' and 'plex' in parent_name.lower():
-            cmdline = ' '.join(pinfo['cmdline'])
-            m = PRT_ID_RE.search(cmdline)
-            if m:
-                session_id = re_get(SESSION_RE, cmdline)
-                data = {
-                    'proc': pinfo,
-                    'plex': plex_sessions.get(session_id, {}),
-                    'host': {}
-                }
+def check_host(config, address, server, paths_modes):
+    """
+    Checks SSH access to a host and the owner and permissions of every path
+    in ``paths_modes`` (required mode to paths) on it, with a single remote
+    ``prt check_paths`` call.  Returns the results as a dict.
+    """
+    report = {"connect": False, "paths": []}
+    paths = [p for req_mode, ps in sorted(paths_modes.items()) for p in ps]
 
-                host = re_get(SSH_HOST_RE, cmdline, 'all')
-                if host:
-                    data['host'] = {
-                        'user':    host[0],
-                        'address': host[1]
-                    }
+    timeout = get_probe_settings(config)[0]
+    ssh = ssh_command(address, server["port"], server["user"], config=config, timeout=timeout)
+    try:
+        proc = subprocess.Popen(ssh + ["prt", "check_paths"] + [pipes.quote(p) for p in paths],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        report["error"] = str(e)
+        return report
+
+    output = communicate_with_timeout(proc, timeout + len(paths))
+    if output is None:
+        report["error"] = "Timed out"
+        return report
+    if proc.returncode != 0:
+        report["error"] = output[1].strip()
+        return report
 
-                sessions[m.groups()[0]] = data
-    return sessions
+    try:
+        results = json.loads(output[0])
+    except ValueError:
+        report["error"] = "Unexpected output from 'prt check_paths': %s" % output[0].strip()
+        return report
+    report["connect"] = True
+
+    for req_mode, ps in sorted(paths_modes.items()):
+        for path in ps:
+            result = dict(results.get(path, {"error": "Not checked"}), path=path,
+                          required_mode=req_mode, warnings=[], errors=[])
+            if "error" in result:
+                result["errors"].append(result.pop("error"))
+            else:
+                mode = int(result["mode"], 8)
+                if result["user"] != "plex":
+                    result["warnings"].append("Not owned by plex user")
+                    if mode & 07 < req_mode:
+                        result["errors"].append("Bad permissions")
+                elif (mode >> 6) & 07 < req_mode:
+                    result["errors"].append("Bad permissions")
+            report["paths"].append(result)
 
-def check_config():
+    return report
+
+
+def check_config(as_json=False):
     """
     Run through various diagnostic checks to see if things are configured
-    correctly.
+    correctly.  All hosts are checked at the same time.  With ``as_json`` the
+    report is printed as JSON instead.
     """
     config = get_config()
-    errors = []
+    report = {"warnings": [], "hosts": {}}
 
-    printf("Performing PRT configuration check\n\n", color="blue", attrs=['bold'])
+    if not as_json:
+        printf("Performing PRT configuration check\n\n", color="blue", attrs=['bold'])
 
     # First, check the user
     user = getpass.getuser()
     if user != "plex":
-        printf("WARNING: Current user is not 'plex'\n", color="red")
+        report["warnings"].append("Current user is not 'plex'")
+        if not as_json:
+            printf("WARNING: Current user is not 'plex'\n", color="red")
 
     try:
         settings_fh = open(SETTINGS_PATH)
         dom = ET.parse(settings_fh)
         settings = dom.getroot().attrib
     except Exception, e:
-        printf("ERROR: Couldn't open settings file - %s", SETTINGS_PATH, color="red")
+        if as_json:
+            print json.dumps({"error": "Couldn't open settings file - %s" % SETTINGS_PATH})
+        else:
+            printf("ERROR: Couldn't open settings file - %s", SETTINGS_PATH, color="red")
         return False
 
-    config = get_config()
     if config.get('auth_token') == None:
-        config['auth_token'] = get_auth_token()
+        if as_json:
+            # Prompting would block unattended runs and garble the JSON
+            report["warnings"].append("No 'auth_token' configured, querying PMS without one")
+            config['auth_token'] = None
+        else:
+            config['auth_token'] = get_auth_token()
 
     url = 'http://localhost:32400/library/sections'
     if config['auth_token']:
         url += "?X-Plex-Token=%s" % config['auth_token']
 
-    res = urllib.urlopen(url)
-    dom = ET.parse(res)
+    try:
+        res = urllib.urlopen(url)
+        dom = ET.parse(res)
+    except Exception, e:
+        if as_json:
+            print json.dumps({"error": "Couldn't get the library sections from PMS - %s" % e,
+                              "warnings": report["warnings"]})
+        else:
+            printf("ERROR: Couldn't get the library sections from PMS - %s\n", e, color="red")
+        return False
     media_paths = []
     for node in dom.findall('.//Location'):
         path = et_get(node, 'path')
@@ -552,55 +3096,77 @@ def check_config():
         7: [settings['TranscoderTempDirectory']]
     }
 
-    # Let's check SSH access
-    for address, server in config['servers'].items():
-        printf("Host %s\n", address)
+    # Let's check SSH access and the paths on every host at once
+    def check(address, server):
+        try:
+            report["hosts"][address] = check_host(config, address, server, paths_modes)
+        except Exception, e:
+            report["hosts"][address] = {"connect": False, "error": str(e), "paths": []}
 
-        proc = subprocess.Popen(["ssh", "%s@%s" % (server["user"], address),
-            "-p", server["port"], "prt", "get_load"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        proc.wait()
+    threads = []
+    for address, server in get_servers(config).items():
+        thread = threading.Thread(target=check, args=(address, server))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    report["ok"] = all(h["connect"] and not any(p["errors"] for p in h["paths"])
+                       for h in report["hosts"].values())
+
+    if as_json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return report["ok"]
+
+    for address, host in sorted(report["hosts"].items()):
+        printf("Host %s\n", address)
 
         printf("  Connect: ")
-        if proc.returncode != 0:
+        if not host["connect"]:
             printf("FAIL\n", color="red")
-            printf("    %s\n" % proc.stderr.read())
+            printf("    %s\n" % host.get("error", ""))
             continue
         else:
             printf("OK\n", color="green")
 
-        for req_mode, paths in paths_modes.items():
-            for path in paths:
-                printf("  Path: '%s'\n", path)
-                proc = subprocess.Popen(["ssh", "%s@%s" % (server["user"], address),
-                    "-p", server["port"], "stat", "--printf='%U %a'", pipes.quote(path)],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                proc.wait()
-
-                username, mode = proc.stdout.read().strip().split()
-                printf("    User:  %s\n", username)
-                printf("    Mode:  %s\n", mode)
-
-                if username != 'plex':
-                    printf("    WARN:  Not owned by plex user\n", color="yellow")
-                    if int(mode[-1]) < req_mode:
-                        printf("    ERROR: Bad permissions\n", color="red")
-                else:
-                    if int(mode[0]) < req_mode:
-                        printf("    ERROR: Bad permissions\n", color="red")
+        for result in host["paths"]:
+            printf("  Path: '%s'\n", result["path"])
+            if "user" in result:
+                printf("    User:  %s\n", result["user"])
+                printf("    Mode:  %s\n", result["mode"])
+            for warning in result["warnings"]:
+                printf("    WARN:  %s\n", warning, color="yellow")
+            for error in result["errors"]:
+                printf("    ERROR: %s\n", error, color="red")
 
         printf("\n")
 
+    return report["ok"]
+
 
-def sessions():
+def sessions(watch=None):
     if psutil is None:
         print "Missing required library 'psutil'.  Try 'pip install psutil'."
         return
 
+    if watch:
+        try:
+            watch_sessions(watch)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    config = get_config()
+    load_cache = read_state(get_state_path(config, "load_cache.json"))
+
     sessions = get_sessions()
     for i, (session_id, session) in enumerate(sessions.items()):
+        address = session.get('host', {}).get('address')
+        load = ["%0.2f%%" % l for l in load_cache.get(address, {}).get('load', [])]
         print "Session %s/%s" % (i+1, len(sessions))
-        print "  Host: %s" % session.get('host', {}).get('address')
+        print "  Host: %s" % address
+        print "  Load: %s" % (", ".join(load) or "unknown")
         print "  File: %s" % session.get('plex', {}).get('file')
 
 
@@ -621,12 +3187,22 @@ def usage():
         "  usage, help, -h, ?    Show usage page\n" 
         "  get_load              Show the load of the system\n" 
         "  get_cluster_load      Show the load of all systems in the cluster\n" 
+        "  status [--json]       Show the load, cores, memory and transcodes of all hosts\n" 
+        "  progress [prt_id]     Show the progress of the transcodes on this system as JSON\n" 
+        "  agent [port] [addr]   Run the load agent daemon on a transcode host\n" 
+        "  metrics [port] [addr] Serve Prometheus metrics for the cluster\n" 
+        "  trace [count]         Summarize startup phase timings of recent transcodes\n" 
+        "  reap [secs]           Kill orphaned PRT processes, every [secs] if given\n" 
+        "  path_server           Serve path_script as a persistent co-process\n" 
+        "  refresh_load [secs]   Refresh the shared load cache, every [secs] if given\n" 
+        "  ssh_mux [stop]        Check (and re-establish) or stop the SSH master connections\n" 
         "  install               Install PRT for the first time and then sets up configuration\n" 
         "  overwrite             Fix PRT after PMS has had a version update breaking PRT\n" 
         "  add_host              Add an extra host to the list of slaves PRT is to use\n" 
         "  remove_host           Removes a host from the list of slaves PRT is to use\n"
-        "  sessions              Display current sessions\n"
-        "  check_config          Checks the current configuration for errors\n")
+        "  sessions [--watch [secs]]\n"
+        "                        Display current sessions, refreshing every [secs] with --watch\n"
+        "  check_config [--json] Checks the current configuration for errors\n")
 
 
 def main():
@@ -641,18 +3217,75 @@ def main():
     #    print ("Warning: You are not running as the Plex user")
     #    return
 
-    # TODO: show_hosts_status to show current status across all nodes
-
     if sys.argv[1] == "get_load":
         print " ".join([str(i) for i in get_system_load_local()])
 
+    elif sys.argv[1] == "get_status":
+        print json.dumps(get_system_status_local())
+
+    elif sys.argv[1] == "status":
+        show_cluster_status(get_config(), as_json="--json" in sys.argv[2:])
+
+    elif sys.argv[1] == "progress":
+        print json.dumps(get_progress_local(get_config(), sys.argv[2] if len(sys.argv) >= 3 else None))
+
     elif sys.argv[1] == "get_cluster_load":
         print "Cluster Load"
         config = get_config()
-        servers = config["servers"]
-        for address, server in servers.items():
-            load = ["%0.2f%%" % l for l in get_system_load_remote(address, server["port"], server["user"])]
-            print "  %15s: %s" % (address, ", ".join(load))
+        servers = get_servers(config)
+        loads, missed = get_cached_loads(config, servers)
+        for address in sorted(servers):
+            load = ["%0.2f%%" % l for l in loads.get(address, [])]
+            print "  %15s: %s" % (address, ", ".join(load) or "unreachable")
+
+    elif sys.argv[1] == "refresh_load":
+        config = get_config()
+        if len(sys.argv) >= 3:
+            run_load_refresher(config, get_servers(config), float(sys.argv[2]))
+        else:
+            refresh_load_cache(config, get_servers(config))
+
+    elif sys.argv[1] == "agent":
+        setup_logging()
+        config = get_config()
+        port = sys.argv[2] if len(sys.argv) >= 3 else config.get("agent_port", DEFAULT_CONFIG["agent_port"])
+        address = sys.argv[3] if len(sys.argv) >= 4 else config.get("agent_address", DEFAULT_CONFIG["agent_address"])
+        run_agent(address, port)
+
+    elif sys.argv[1] == "ssh_mux":
+        config = get_config()
+        stop = len(sys.argv) >= 3 and sys.argv[2] == "stop"
+        for address, server in sorted(get_servers(config).items()):
+            if stop:
+                stopped = stop_ssh_master(config, address, server["port"], server["user"])
+                print "  %15s: %s" % (address, "stopped" if stopped else "not running")
+            else:
+                path = ensure_ssh_master(config, address, server["port"], server["user"],
+                                         timeout=get_probe_settings(config)[0])
+                print "  %15s: %s" % (address, "OK" if path else "FAIL")
+
+    elif sys.argv[1] == "metrics":
+        setup_logging()
+        config = get_config()
+        port = sys.argv[2] if len(sys.argv) >= 3 else config.get("metrics_port", DEFAULT_CONFIG["metrics_port"])
+        address = sys.argv[3] if len(sys.argv) >= 4 else config.get("metrics_address", DEFAULT_CONFIG["metrics_address"])
+        run_metrics_server(address, port)
+
+    elif sys.argv[1] == "trace":
+        summarize_traces(get_config(), int(sys.argv[2]) if len(sys.argv) >= 3 else 1000)
+
+    elif sys.argv[1] == "reap":
+        setup_logging()
+        config = get_config()
+        if len(sys.argv) >= 3:
+            run_reaper(config, float(sys.argv[2]))
+        else:
+            print "Reaped %d orphaned PRT processes" % reap_orphans(config)
+            print "Reaped %d abandoned transcodes" % reap_transcodes(config)
+
+    elif sys.argv[1] == "path_server":
+        setup_logging()
+        run_path_server(get_config())
 
     elif sys.argv[1] == "install":
         print "Installing Plex Remote Transcoder"
@@ -716,10 +3349,17 @@ def main():
             print "Transcoder overwritten successfully"
 
     elif sys.argv[1] == "sessions":
-        sessions()
+        watch = None
+        if len(sys.argv) >= 3 and sys.argv[2] == "--watch":
+            watch = float(sys.argv[3]) if len(sys.argv) >= 4 else 2.0
+        sessions(watch=watch)
 
     elif sys.argv[1] == "check_config":
-        check_config()
+        if not check_config(as_json="--json" in sys.argv[2:]):
+            sys.exit(1)
+
+    elif sys.argv[1] == "check_paths":
+        print json.dumps(check_paths_local(sys.argv[2:]))
 
     # Todo: list_hosts option to show current hosts to aid add/remove_host options - Liviynz
 